@@ -3,17 +3,17 @@ import cv2
 import gym
 import random
 import time
-import itertools
-import codecs
-import math
 import os
+import math
 
 from loguru import logger
 from keras.models import load_model
 from gym import Env, spaces
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
+import profiling
 
 class PEBinary():
     def __init__(self, bytepath, asmpath):
@@ -21,96 +21,66 @@ class PEBinary():
         self.asmpath = asmpath
         
         self.matrix = None 
+        # Read-only bytes of the binary before any injection
+        self.pristine = None
         self.base_address = None
         self.inject_locations = None
         self.locations_by_section = None
+        # Flat indices of the injectable bytes of each section in matrix
+        self.section_indices = None
         # Number of sections in the binary
         self.nsections = None
+        # Canvas of the matrix and its state before any injection, set by the env
+        self.grid = None
+        self.grid_snapshot = None
         
         self.init_matrix()
         self.get_inject_locations()
         
         self.nsections = self.group_locations()
+        self.init_section_indices()
         
         
     def init_matrix(self):
-        with open(self.bytepath, 'r') as f:
-            arr = []
-            lines = f.readlines()
-            
-            # Get base_address
-            self.base_address = int(lines[0].split()[0], 16)
-            
-            for line in lines:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            
+        self.base_address = utils.get_base_address(self.bytepath)
+        self.pristine = utils.reshape_square(utils.parse_bytes(self.bytepath))
+        self.pristine.flags.writeable = False
         
-            raw_width = math.floor(math.sqrt(len(byte_arr)))
-            
-            rem = len(byte_arr) % raw_width
-            byte_arr_len = len(byte_arr) - rem
-            byte_arr = byte_arr[:byte_arr_len]
-            byte_arr = np.asarray(byte_arr)
-            np_arr = np.reshape(byte_arr, (len(byte_arr)// raw_width, raw_width))
-            np_arr = np.uint8(np_arr)
-            
-            self.matrix = np_arr
-
+        # injections write to a contiguous working copy through a flat view
+        self.matrix = np.array(self.pristine)
+        
+    def restore(self):
+        # Undo every injection
+        np.copyto(self.matrix, self.pristine)
+        
+    def init_grid(self, width=256, height=256):
+        self.grid = utils.CanvasGrid(self.matrix.shape, width, height)
+        self.grid.fit(self.matrix)
+        self.grid_snapshot = self.grid.snapshot()
+    
+    def init_section_indices(self):
+        self.section_indices = {}
+        for section, locations in self.locations_by_section.items():
+            offsets = np.array([loc[0] for loc in locations], dtype=np.int64) - self.base_address
+            lengths = np.array([loc[1] for loc in locations], dtype=np.int64)
+            indices = np.unique(utils.runs_to_indices(offsets, lengths))
+            self.section_indices[section] = indices[(indices >= 0) & (indices < self.matrix.size)]
     
     def inject(self, data, value):
         offset = data[0] - self.base_address
         length = data[1]
-        print("Injecting at", offset, " with length ", length)
-        self.matrix[offset: offset + length] = value
+        self.matrix.reshape(-1)[max(offset, 0): max(offset + length, 0)] = value
         
     def inject_section(self, section, value):
-        for loc in self.locations_by_section[section]:
-            self.inject(loc, value)
+        # return the injected indices with their previous values
+        indices = self.section_indices[section]
+        old_values = self.matrix.reshape(-1)[indices]
+        self.matrix.reshape(-1)[indices] = value
+        return indices, old_values
 
 
     def get_inject_locations(self):
-        with codecs.open(self.asmpath, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-            results = []
-            idx = 0
-            numlines = len(lines)
-            while idx < numlines:
-                if lines[idx].find('align ') != -1:
-                    # print("Processing line", idx, lines[idx])
-                    section, address = (lines[idx].replace('\t', ' ').split(' ')[0]).split(':')
-                    # print(section, address)
-                    
-                    found = False
-                    while not found:
-                        if idx + 1 < numlines:
-                            nextline = lines[idx+1]
-                            _, next_address = nextline.replace('\t', ' ').split(' ')[0].split(':')
-                            if address != next_address:
-                                found = True
-                                length = int(next_address, 16) - int(address, 16)
-                                results.append((section, int(address, 16), length))
-                            idx += 1
-                        else:
-                            found = True
-                idx += 1
-                
-            self.inject_locations = results
+        self.inject_locations = utils.load_inject_locations(self.asmpath)
             
     def group_locations(self):
         locations = sorted(self.inject_locations, key=lambda x: x[2], reverse=True)
@@ -129,13 +99,36 @@ class InjectorEnv(gym.Env):
     """Custom Environment that follows gym interface"""
     metadata = {'render.modes': ['human']}
 
-    def __init__(self):
+    def __init__(self,
+                 bytefolder="D:\\Big2015\\dataset-10-8-2\\8-2-0.0\\train-bytes\\1",
+                 asmfolder="D:\\Big2015\\dataset-10-8-2\\8-2-0.0\\8.2.0.0-asm\\train-asm\\1",
+                 corpus_fp=None,
+                 manifest_fp=None,
+                 split="train",
+                 family=1,
+                 model=None,
+                 model_fp="C:\\Users\\hao.le\\Documents\\Projects\\Thesis\\kltn\\model\\checkpoint.h5",
+                 start_idx=0,
+                 file_step=1,
+                 pool_size=0,
+                 cycle_files=True,
+                 prefetch=0,
+                 score_cache_size=1024,
+                 channels=None):
         super(InjectorEnv, self).__init__()
 
-        self.model = load_model("C:\\Users\\hao.le\\Documents\\Projects\\Thesis\\kltn\\model\\checkpoint.h5")
+        if corpus_fp:
+            utils.load_corpus(corpus_fp)
+
+        # the classifier can be shared between environments
+        self.model = model if model is not None else load_model(model_fp)
 
-        self.bytefolder = "D:\\Big2015\\dataset-10-8-2\\8-2-0.0\\train-bytes\\1"
-        self.asmfolder = "D:\\Big2015\\dataset-10-8-2\\8-2-0.0\\8.2.0.0-asm\\train-asm\\1"
+        self.bytefolder = bytefolder
+        self.asmfolder = asmfolder
+        # bytes files can also come from the manifest of a split
+        self.manifest_fp = manifest_fp
+        self.split = split
+        self.family = family
         
         self.bytes = []
         self.asms = []
@@ -148,44 +141,140 @@ class InjectorEnv(gym.Env):
         
         self.max_injections = 50
         self.injections_left = 50
-        self.current_file_idx = -1
+        # index of the first file and number of files skipped by next_file
+        self.current_file_idx = start_idx - file_step
+        self.file_step = file_step
+        # pool_size binaries parsed once by file index, next_file cycles through
+        # them and restores them from their pristine bytes instead of parsing
+        self.pool_size = pool_size
+        self.pool = {}
+        self.pool_order = []
+        self.pool_pos = -1
+        # reset moves to the next file, or restores the current one
+        self.cycle_files = cycle_files
+        # number of next files loaded in a background thread
+        self.prefetch = prefetch
+        self.prefetched = {}
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        # classifier outputs of already seen canvases
+        # canvases are fed grayscale to 1-channel classifiers
+        self.channels = channels or utils.model_channels(self.model)
+        self.score_cache = utils.ScoreCache(score_cache_size, self.channels)
         self.PEBinary = None
         
         self.canvas = np.full(self.observation_shape[0], 255, dtype=np.uint8)
+        self.grid = None
         self.nsections = 0
         
         self.load_input()
 
     def load_input(self):
-        for file in os.listdir(self.bytefolder):
-            if file.endswith(".bytes"):
-                path = os.path.join(self.bytefolder, file)
+        # asm files placed with link_mode "index" are only listed in an index.json
+        asm_index = utils.load_asm_index(self.asmfolder, self.family)
+        if self.manifest_fp:
+            for path in utils.resolve_split(self.manifest_fp, self.split, self.family):
+                file = os.path.basename(path).replace(".bytes", ".asm")
                 self.bytes.append(path)
-                
-        for file in os.listdir(self.asmfolder):
-            if file.endswith(".asm"):
-                path = os.path.join(self.asmfolder, file)
-                self.asms.append(path)
+                self.asms.append(asm_index.get(file, os.path.join(self.asmfolder, file)))
+        else:
+            for file in sorted(os.listdir(self.bytefolder)):
+                if file.endswith(".bytes"):
+                    path = os.path.join(self.bytefolder, file)
+                    self.bytes.append(path)
+                    
+            if asm_index:
+                for path in self.bytes:
+                    file = os.path.basename(path).replace(".bytes", ".asm")
+                    self.asms.append(asm_index.get(file, os.path.join(self.asmfolder, file)))
+            else:
+                for file in sorted(os.listdir(self.asmfolder)):
+                    if file.endswith(".asm"):
+                        path = os.path.join(self.asmfolder, file)
+                        self.asms.append(path)
+
+        if self.pool_size:
+            self.preload_pool()
                 
         valid = False
         while not valid:
             valid = self.next_file()
         
         
+    def preload_pool(self):
+        # Parse the first pool_size valid files this env walks through
+        nfiles = len(self.bytes) // math.gcd(self.file_step, len(self.bytes))
+        idx = self.current_file_idx
+        for _ in range(nfiles):
+            if len(self.pool) == self.pool_size:
+                break
+            idx = (idx + self.file_step) % len(self.bytes)
+            binary = self.build_binary(idx)
+            if binary.nsections <= 5:
+                self.pool[idx] = binary
+        self.pool_order = list(self.pool)
+
     def next_file(self):
-        if self.current_file_idx >= len(self.bytes):
-            self.current_file_idx = 0
+        if self.pool_order:
+            self.pool_pos = (self.pool_pos + 1) % len(self.pool_order)
+            self.current_file_idx = self.pool_order[self.pool_pos]
         else:
-            self.current_file_idx += 1
-        self.PEBinary = PEBinary(self.bytes[self.current_file_idx],
-                                 self.asms[self.current_file_idx])
+            self.current_file_idx = (self.current_file_idx + self.file_step) % len(self.bytes)
+        self.PEBinary = self.load_binary(self.current_file_idx)
+        self.prefetch_files()
         self.nsections = self.PEBinary.nsections
         
         if self.nsections > 5:
             return False
         return True
 
+    def load_binary(self, idx):
+        if idx in self.pool:
+            binary = self.pool[idx]
+            binary.restore()
+            profiling.count("binary_pool_hits")
+            return binary
+
+        future = self.prefetched.pop(idx, None)
+        if future is not None:
+            with profiling.timer("prefetch_wait"):
+                binary = future.result()
+            profiling.count("binary_prefetch_hits")
+        else:
+            binary = self.build_binary(idx)
+        return binary
+
+    def build_binary(self, idx):
+        # Parse a binary and its initial canvas, also run in the prefetch thread
+        with profiling.timer("build_binary"):
+            binary = PEBinary(self.bytes[idx], self.asms[idx])
+            binary.init_grid(256, 256)
+        return binary
+    
+    def prefetch_files(self):
+        # Load the next files in the background, pooled files are already loaded
+        if not self.prefetch or self.pool_order:
+            return
+        
+        upcoming = [
+            (self.current_file_idx + k * self.file_step) % len(self.bytes)
+            for k in range(1, self.prefetch + 1)
+        ]
+        for idx in list(self.prefetched):
+            if idx not in upcoming:
+                self.prefetched.pop(idx).cancel()
+        for idx in upcoming:
+            if idx not in self.prefetched and idx != self.current_file_idx:
+                self.prefetched[idx] = self.executor.submit(self.build_binary, idx)
+
     def step(self, action):
+        with profiling.timer("env_step"):
+            reward, done = self.apply_action(action)
+            prediction = self.predict_binary()
+        
+        return (self.canvas, self.nsections) , reward, done, {"prediction": prediction}
+    
+    def apply_action(self, action):
+        # Inject without scoring, return reward and done
         done = False
         reward = 0
         
@@ -202,27 +291,48 @@ class InjectorEnv(gym.Env):
         keys = list(self.PEBinary.locations_by_section.keys())
         if section_idx < len(keys):
             section = keys[section_idx]
-            self.PEBinary.inject_section(section, code)
+            indices, old_values = self.PEBinary.inject_section(section, code)
+            self.update_canvas(indices, old_values, code)
         else:
             reward = -10
         
-        self.update_canvas()
-        
-        return (self.canvas, self.nsections) , reward, done, {}
+        return reward, done
+    
+    def predict_binary(self):
+        # Family probabilities of the current canvas
+        return self.score_cache.predict(self.model, [self.canvas])[0]
     
-    def update_canvas(self):
-        img = utils.np2img(self.PEBinary.matrix, 256, 256)
-        self.canvas = np.asarray(img)
+    def init_canvas(self):
+        # Canvas of the pristine binary, computed once per binary
+        binary = self.PEBinary
+        if binary.grid is None:
+            binary.init_grid(256, 256)
+        else:
+            binary.grid.restore(binary.grid_snapshot)
+        self.grid = binary.grid
+        self.canvas = self.grid.canvas.copy()
+
+    def update_canvas(self, indices=None, old_values=None, value=None):
+        # Recompute the whole canvas, or only the cells of the injected bytes
+        if indices is None:
+            canvas = self.grid.fit(self.PEBinary.matrix)
+        else:
+            canvas = self.grid.update(indices, old_values, value)
+        self.canvas = canvas.copy()
 
     def reset(self):
-        # Reset the number of injections left
-        self.injections_left = self.max_injections
-        
-        # Get next input file
-        self.next_file()
-        
-        # Map PE Binary to canvas (256 x 256)
-        self.update_canvas()
+        with profiling.timer("env_reset"):
+            # Reset the number of injections left
+            self.injections_left = self.max_injections
+
+            # Get next input file, or undo the injections of the current one
+            if self.cycle_files:
+                self.next_file()
+            else:
+                self.PEBinary.restore()
+
+            # Map PE Binary to canvas (256 x 256)
+            self.init_canvas()
 
         # # Draw elements on the canvas
         # self.draw_canvas()
@@ -239,6 +349,8 @@ class InjectorEnv(gym.Env):
             return self.canvas
 
     def close (self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
         cv2.destroyAllWindows()
     
 if __name__ == "__main__":
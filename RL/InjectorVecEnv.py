@@ -0,0 +1,113 @@
+import numpy as np
+
+from gym import spaces
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv
+
+from InjectorEnv import InjectorEnv
+
+
+class InjectorVecEnv(VecEnv):
+    """
+        N InjectorEnv stepped in lockstep sharing one classifier, the N canvases
+        of a step are scored with a single batched predict call
+
+        Observations are dicts of stacked arrays, SB3 policies support Dict
+        but not Tuple observation spaces:
+            {"canvas": (N, 256, 256, 1) uint8, "nsections": (N,) int}
+    """
+
+    def __init__(self, num_envs, model=None, **kwargs):
+        # env i starts at file i and walks every num_envs files,
+        # the model is loaded by the first env if not given
+        self.envs = [InjectorEnv(model=model, start_idx=0, file_step=num_envs, **kwargs)]
+        self.model = self.envs[0].model
+        self.score_cache = self.envs[0].score_cache
+        self.envs += [
+            InjectorEnv(model=self.model, start_idx=i, file_step=num_envs, **kwargs)
+            for i in range(1, num_envs)
+        ]
+        self.actions = None
+
+        env = self.envs[0]
+        # binaries have 1 to 5 sections
+        observation_space = spaces.Dict({
+            "canvas": spaces.Box(low=0, high=255, shape=env.observation_shape[0], dtype=np.uint8),
+            "nsections": spaces.Discrete(6),
+        })
+        super(InjectorVecEnv, self).__init__(num_envs, observation_space, env.action_space)
+
+    def observations(self):
+        env = self.envs[0]
+        canvases = np.stack([env.canvas for env in self.envs])
+        canvases = canvases.reshape((self.num_envs,) + env.observation_shape[0])
+        nsections = np.array([env.nsections for env in self.envs])
+        return {"canvas": canvases, "nsections": nsections}
+
+    def predict_binaries(self):
+        # Family probabilities of every canvas, uncached canvases in one forward pass
+        return self.score_cache.predict(self.model, [env.canvas for env in self.envs])
+
+    def reset(self):
+        for env in self.envs:
+            env.reset()
+        return self.observations()
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        for i, (env, action) in enumerate(zip(self.envs, self.actions)):
+            rewards[i], dones[i] = env.apply_action(action)
+
+        predictions = self.predict_binaries()
+        infos = [{"prediction": prediction} for prediction in predictions]
+
+        # auto reset finished envs, keeping their last observation like SB3 does
+        if dones.any():
+            observations = self.observations()
+            for i in np.flatnonzero(dones):
+                infos[i]["terminal_observation"] = {key: value[i] for key, value in observations.items()}
+                self.envs[i].reset()
+
+        return self.observations(), rewards, dones, infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def get_images(self):
+        return [env.render(mode="rgb_array") for env in self.envs]
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(env, attr_name) for env in self.target_envs(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        for env in self.target_envs(indices):
+            setattr(env, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [
+            getattr(env, method_name)(*method_args, **method_kwargs)
+            for env in self.target_envs(indices)
+        ]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [isinstance(env, wrapper_class) for env in self.target_envs(indices)]
+
+    def seed(self, seed=None):
+        return [None for _ in self.envs]
+
+    def target_envs(self, indices):
+        if indices is None:
+            indices = range(self.num_envs)
+        elif isinstance(indices, int):
+            indices = [indices]
+        return [self.envs[i] for i in indices]
+
+
+if __name__ == "__main__":
+    vec_env = InjectorVecEnv(8)
+    obs = vec_env.reset()
+    obs, rewards, dones, infos = vec_env.step(np.array([vec_env.action_space.sample() for _ in range(8)]))
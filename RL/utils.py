@@ -1,28 +1,33 @@
-import itertools
 from loguru import logger
 import numpy as np
 from PIL import Image
 import math
-import codecs
-from collections import defaultdict 
+import json
+import os
+import re
+import mmap
+import sys
+import hashlib
+from collections import defaultdict, OrderedDict
 
-def resize_image(image: Image.Image, width: int = 256, height: int = 256):
-    # resize image keeping aspect ratio
-    image.thumbnail((width, height), Image.ANTIALIAS)
-    
-    # calculate offset to make image in the center
-    w, h = image.size
-    if w < width:
-        offset = ((width - w) // 2, 0)
-    elif h < height:
-        offset = (0, (height - h) // 2)
-    else:
-        offset = (0, 0)
-
-    # add padding
-    new_img = Image.new(image.mode, (width, height))
-    new_img.paste(image, offset)
-    return new_img
+# shared modules live in utils/ at the root of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils"))
+import profiling
+from codec import (
+    block_sum,
+    get_base_address,
+    letterbox,
+    letterbox_offset,
+    load_corpus,
+    parse_bytes,
+    reshape_square,
+    resize_image,
+    thumbnail_grid,
+)
+from manifest import (
+    load_asm_index,
+    resolve_split,
+)
 
 
 def byte2img(filepath: str, width: int = 256, height: int = 256):
@@ -32,38 +37,17 @@ def byte2img(filepath: str, width: int = 256, height: int = 256):
         @filepath: bytes filepath
     """
     try:
-        with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            rem = len(byte_arr) % width
-            byte_arr_len = len(byte_arr) - rem
-            byte_arr = byte_arr[:byte_arr_len]
-            byte_arr = np.asarray(byte_arr)
-            np_arr = np.reshape(byte_arr, (len(byte_arr)//width, width))
-            np_arr = np.uint8(np_arr)
-            img = Image.fromarray(np_arr)
+        byte_arr = parse_bytes(filepath)
+        rem = len(byte_arr) % width
+        byte_arr_len = len(byte_arr) - rem
+        byte_arr = byte_arr[:byte_arr_len]
+        np_arr = np.reshape(byte_arr, (len(byte_arr)//width, width))
+        img = Image.fromarray(np_arr)
 
-            # if width and height:
-            #     img = resize_image(img, width, height)
+        # if width and height:
+        #     img = resize_image(img, width, height)
 
-            return img
+        return img
     except Exception as error:
         logger.error(f"Cant convert bytes to image: {error}")
         
@@ -76,59 +60,20 @@ def get_binary_dimension(filepath: str):
     """
     
     try:
-        with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            
-            raw_width = math.floor(math.sqrt(len(byte_arr)))
-            
-            raw_height = len(byte_arr) // raw_width
-            
-            return (raw_width, raw_height)
+        byte_arr = parse_bytes(filepath)
+        
+        raw_width = math.floor(math.sqrt(len(byte_arr)))
+        
+        raw_height = len(byte_arr) // raw_width
+        
+        return (raw_width, raw_height)
         
     except Exception as error:
         logger.error(f"Cant convert bytes to numpy array: {error}")
         
 def byte2np(filepath: str):
     try:
-       with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            return byte_arr
+        return parse_bytes(filepath)
         
     except Exception as error:
         logger.error(f"Cant convert bytes to numpy array: {error}")
@@ -140,37 +85,7 @@ def byte2np_square(filepath: str):
         @filepath: bytes filepath
     """
     try:
-        with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            
-            raw_width = math.floor(math.sqrt(len(byte_arr)))
-            
-            rem = len(byte_arr) % raw_width
-            byte_arr_len = len(byte_arr) - rem
-            byte_arr = byte_arr[:byte_arr_len]
-            byte_arr = np.asarray(byte_arr)
-            np_arr = np.reshape(byte_arr, (len(byte_arr)// raw_width, raw_width))
-            np_arr = np.uint8(np_arr)
-            
-            return np_arr
+        return reshape_square(parse_bytes(filepath))
         
     except Exception as error:
         logger.error(f"Cant convert bytes to numpy array: {error}")
@@ -186,35 +101,106 @@ def byte2img_square(filepath, width=None, height=None):
     except Exception as error:
         logger.error(f"Cant convert bytes to numpy array: {error}")
     
+# section and address prefix of asm lines, e.g. ".text:00401000"
+ASM_LINE = re.compile(rb"([^\s:]+):([^\s:]+)")
+
 # Take asm as input and parse the "align" location in binary
-# Return a list of (sectionname, injectable address, length)    
+# Yield (sectionname, injectable address, length) in a single pass over the
+# memory-mapped file, lines without "align" are skipped with a plain find
+def iter_inject_locations(filepath):
+    if not os.path.getsize(filepath):
+        return
+
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+
+        # start of the next line, the end of the file if it has no trailing newline
+        def line_end(pos):
+            end = mm.find(b"\n", pos)
+            return size if end == -1 else end + 1
+
+        pos = 0
+        while pos < size:
+            idx = mm.find(b"align ", pos)
+            if idx == -1:
+                return
+            line_start = mm.rfind(b"\n", 0, idx) + 1
+            pos = line_end(idx)
+            match = ASM_LINE.match(mm, line_start)
+            if not match:
+                continue
+            section, address = match.groups()
+
+            # the gap ends at the first next line with another address,
+            # that line is consumed with the gap like before
+            while pos < size:
+                next_match = ASM_LINE.match(mm, pos)
+                pos = line_end(pos)
+                if next_match and next_match.group(2) != address:
+                    start = int(address, 16)
+                    yield (section.decode('utf-8', errors='ignore'), start, int(next_match.group(2), 16) - start)
+                    break
+
 def get_inject_locations(filepath):
-    with codecs.open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = f.readlines()
-        results = []
-        idx = 0
-        numlines = len(lines)
-        while idx < numlines:
-            if lines[idx].find('align ') != -1:
-                # print("Processing line", idx, lines[idx])
-                section, address = (lines[idx].replace('\t', ' ').split(' ')[0]).split(':')
-                # print(section, address)
-                
-                found = False
-                while not found:
-                    if idx + 1 < numlines:
-                        nextline = lines[idx+1]
-                        _, next_address = nextline.replace('\t', ' ').split(' ')[0].split(':')
-                        if address != next_address:
-                            found = True
-                            length = int(next_address, 16) - int(address, 16)
-                            results.append((section, int(address, 16), length))
-                        idx += 1
-                    else:
-                        found = True
-            idx += 1
+    with profiling.timer("asm_scan"):
+        return list(iter_inject_locations(filepath))
+    
+def hash_file(filepath, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Same as get_inject_locations but cached in a {asm}.locations.json sidecar
+# keyed by the content hash of the asm file, the hash is only recomputed when
+# the size or mtime of the asm file changed
+def load_inject_locations(filepath):
+    sidecar = f"{filepath}.locations.json"
+    stat = os.stat(filepath)
+    
+    cached = None
+    if os.path.isfile(sidecar):
+        try:
+            with open(sidecar, 'r') as f:
+                cached = json.load(f)
+        except Exception as error:
+            logger.warning(f"Cant read inject locations {sidecar}: {error}")
             
-        return results
+    if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+        profiling.count("asm_sidecar_hits")
+        return [tuple(loc) for loc in cached["locations"]]
+    
+    digest = hash_file(filepath)
+    if cached and cached["hash"] == digest:
+        locations = [tuple(loc) for loc in cached["locations"]]
+    else:
+        locations = get_inject_locations(filepath)
+        
+    try:
+        with open(f"{sidecar}.tmp", 'w') as f:
+            json.dump({
+                "hash": digest,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "locations": locations,
+            }, f)
+        os.replace(f"{sidecar}.tmp", sidecar)
+    except Exception as error:
+        logger.warning(f"Cant write inject locations {sidecar}: {error}")
+        
+    return locations
+
+# Precompute the inject locations sidecar of every asm file in a folder
+def cache_inject_locations(folder):
+    count = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if file.endswith(".asm"):
+                load_inject_locations(os.path.join(root, file))
+                count += 1
+    logger.success(f"Cached inject locations of {count} asm files in {folder}")
+    return count
     
 def group_locations(locations):
     locations = sorted(locations, key=lambda x: x[2], reverse=True)
@@ -225,6 +211,144 @@ def group_locations(locations):
         
     return d
 
+def runs_to_indices(offsets, lengths):
+    """
+        Flat indices covered by runs [offset, offset + length)
+
+        @offsets: start of every run
+        @lengths: length of every run, negative lengths are empty runs
+    """
+    lengths = np.maximum(lengths, 0)
+    total = int(lengths.sum())
+    run_starts = np.repeat(offsets - (np.cumsum(lengths) - lengths), lengths)
+    return run_starts + np.arange(total, dtype=np.int64)
+
+class CanvasGrid:
+    """
+        Area-averaged thumbnail of a matrix padded to width x height like
+        letterbox, keeping the sum of every cell so that changed bytes
+        only recompute the cells they fall in
+
+        @shape: shape of the matrix
+    """
+
+    def __init__(self, shape, width=256, height=256):
+        rows, cols = shape
+        self.cols = cols
+        self.w, self.h, self.row_starts, self.col_starts, counts = thumbnail_grid(rows, cols, width, height)
+        self.counts = counts.ravel()
+        
+        # cell of every row and column of the matrix
+        self.row_cell = np.arange(rows) * self.h // rows
+        self.col_cell = np.arange(cols) * self.w // cols
+        self.sums = np.zeros(self.h * self.w, dtype=np.float64)
+        
+        # same centering as letterbox
+        x, y = letterbox_offset(self.w, self.h, width, height)
+        self.canvas = np.zeros((height, width), dtype=np.uint8)
+        self.thumbnail = self.canvas[y: y + self.h, x: x + self.w]
+        
+    def fit(self, matrix):
+        with profiling.timer("canvas_fit"):
+            sums = block_sum(block_sum(matrix, self.row_starts, 0), self.col_starts, 1)
+            self.sums = sums.astype(np.float64).ravel()
+            self.thumbnail[:] = np.rint(sums / self.counts.reshape(sums.shape))
+        return self.canvas
+    
+    def snapshot(self):
+        return self.sums.copy(), self.canvas.copy()
+    
+    def restore(self, snapshot):
+        sums, canvas = snapshot
+        np.copyto(self.sums, sums)
+        np.copyto(self.canvas, canvas)
+    
+    def update(self, indices, old_values, value):
+        """
+            Update cells after matrix.flat[indices] changed from old_values to value,
+            indices must be unique
+        """
+        if not len(indices):
+            return self.canvas
+        with profiling.timer("canvas_update"):
+            cells = self.row_cell[indices // self.cols] * self.w + self.col_cell[indices % self.cols]
+            delta = np.asarray(value, dtype=np.float64) - old_values
+            touched = np.unique(cells)
+            self.sums[touched] += np.bincount(np.searchsorted(touched, cells), weights=delta, minlength=len(touched))
+            self.thumbnail[touched // self.w, touched % self.w] = np.rint(self.sums[touched] / self.counts[touched])
+        return self.canvas
+
+def model_channels(model, default=3):
+    # Number of input channels of a Keras classifier, default when unknown
+    shape = getattr(model, "input_shape", None)
+    if isinstance(shape, tuple) and len(shape) == 4 and shape[-1] in (1, 3):
+        return shape[-1]
+    return default
+
+def canvas2batch(canvases, channels=3):
+    """
+        Stack (256, 256) canvases into a (N, 256, 256, channels) classifier batch,
+        the grayscale canvas is repeated on the channels of RGB classifiers
+    """
+    batch = np.asarray(canvases, dtype=np.float32)[..., np.newaxis]
+    if channels == 1:
+        return batch
+    return np.repeat(batch, channels, axis=-1)
+
+class ScoreCache:
+    """
+        Bounded LRU of classifier outputs keyed by a hash of the canvas
+
+        @size: max number of cached outputs, 0 disables the cache
+        @channels: input channels of the classifier, 1 keeps canvases grayscale
+    """
+
+    def __init__(self, size=1024, channels=3):
+        self.size = size
+        self.channels = channels
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    @staticmethod
+    def key(canvas):
+        return hashlib.blake2b(np.ascontiguousarray(canvas).data, digest_size=16).digest()
+    
+    def get(self, key):
+        score = self.scores.get(key)
+        if score is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.scores.move_to_end(key)
+        return score
+    
+    def put(self, key, score):
+        if not self.size:
+            return
+        self.scores[key] = score
+        self.scores.move_to_end(key)
+        while len(self.scores) > self.size:
+            self.scores.popitem(last=False)
+            
+    def predict(self, model, canvases):
+        """
+            Predict a batch of canvases, only the canvases missing from the
+            cache go through the model, in one batch
+        """
+        keys = [self.key(canvas) for canvas in canvases]
+        scores = [self.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        profiling.count("score_cache_hits", len(canvases) - len(missing))
+        profiling.count("score_cache_misses", len(missing))
+        if missing:
+            with profiling.timer("model_predict"):
+                predictions = model.predict(canvas2batch([canvases[i] for i in missing], self.channels))
+            for i, prediction in zip(missing, predictions):
+                scores[i] = prediction
+                self.put(keys[i], prediction)
+        return np.stack(scores)
+
 def np2img(np, width=None, height=None):
     
     
@@ -237,6 +361,11 @@ def np2img(np, width=None, height=None):
 
 
 if __name__ == "__main__":
+    # python utils.py <asm folder>: precompute inject locations of a family folder
+    if len(sys.argv) > 1:
+        cache_inject_locations(sys.argv[1])
+        sys.exit()
+    
     bytepath = "./dataSample/0A32eTdBKayjCWhZqDOQ.bytes"
     asmpath = "./dataSample/0A32eTdBKayjCWhZqDOQ.asm"
     
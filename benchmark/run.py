@@ -0,0 +1,218 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from loguru import logger
+from typing import (
+    Callable,
+    Dict
+)
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, f"{ROOT}/utils")
+
+import synthetic
+from configs import SplitedPercent
+
+
+def load_module(name: str, filepath: str, utils_module=None):
+    """
+        Import a module of the repo by path, source/ and RL/ both have a
+        utils module so "utils" is pointed to utils_module while importing
+    """
+    saved = sys.modules.get("utils")
+    if utils_module is not None:
+        sys.modules["utils"] = utils_module
+    try:
+        spec = importlib.util.spec_from_file_location(name, filepath)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        if saved is not None:
+            sys.modules["utils"] = saved
+        else:
+            sys.modules.pop("utils", None)
+
+
+class StubModel:
+    """
+        Stands for the Keras classifier, uniform probabilities over the families
+    """
+    num_classes = 9
+
+    def predict(self, x, batch_size=None, **kwargs):
+        return np.full((len(x), self.num_classes), 1 / self.num_classes, dtype=np.float32)
+
+
+def measure(fn: Callable, repeat: int = 3, items: int = 1, nbytes: int = 0) -> Dict[str, float]:
+    """
+        Time fn over repeat runs, peak memory is measured on a separate traced run
+
+        @items: number of items handled by one call of fn
+        @nbytes: number of input bytes handled by one call of fn
+    """
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    seconds = float(np.median(times))
+    result = {
+        "seconds": seconds,
+        "min_seconds": float(np.min(times)),
+        "runs": repeat,
+        "items_per_s": items / seconds,
+        "peak_mb": peak / 1e6,
+    }
+    if nbytes:
+        result["mb_per_s"] = nbytes / seconds / 1e6
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return ""
+
+
+def run(
+        folder: str,
+        size: int = 1 << 18,
+        samples_per_family: int = 10,
+        repeat: int = 3,
+        steps: int = 50,
+        workers: int = 1,
+) -> Dict:
+    logger.info(f"Generate corpus - {samples_per_family} samples per family of {size} bytes")
+    bytes_folder, asm_folder = synthetic.generate_corpus(folder, samples_per_family, size)
+    sample_id = sorted(os.listdir(f"{bytes_folder}/1"))[0].replace(".bytes", "")
+    bytes_fp = f"{bytes_folder}/1/{sample_id}.bytes"
+    asm_fp = f"{asm_folder}/{sample_id}.asm"
+    bytes_files = [
+        f"{bytes_folder}/{family}/{file}"
+        for family in sorted(os.listdir(bytes_folder))
+        for file in sorted(os.listdir(f"{bytes_folder}/{family}"))
+    ]
+
+    rl_utils = load_module("rl_utils", f"{ROOT}/RL/utils.py")
+    source_utils = load_module("source_utils", f"{ROOT}/source/utils.py")
+
+    def bench_split_files():
+        root_folder = tempfile.mkdtemp(dir=folder)
+        splited_percent = SplitedPercent(train=80, valid=10, test=10)
+        folder_out_list = source_utils.generate_folder_out_name(root_folder, splited_percent)
+        source_utils.split_files(bytes_folder, splited_percent, folder_out_list, workers=workers)
+
+    matrix = rl_utils.byte2np_square(bytes_fp)
+    batch = np.stack([matrix] * 16)
+    batch_out = np.empty((len(batch), 256, 256), dtype=np.uint8)
+
+    def bench_env():
+        InjectorEnv = load_module("InjectorEnv", f"{ROOT}/RL/InjectorEnv.py", rl_utils)
+        env = InjectorEnv.InjectorEnv(bytefolder=f"{bytes_folder}/1", asmfolder=asm_folder, model=StubModel())
+        rng = np.random.default_rng(0)
+        actions = [np.array([rng.integers(0, env.nsections), rng.integers(0, 255)]) for _ in range(steps)]
+
+        def episode():
+            env.reset()
+            for action in actions:
+                env.step(action)
+
+        return {
+            "env_reset": measure(env.reset, repeat),
+            "env_step": measure(episode, repeat, steps),
+        }
+
+    def bench_predict():
+        predictor = load_module("predictor", f"{ROOT}/utils/predictor.py", source_utils)
+        predictor.predictors["stub"] = predictor.Predictor("stub", model=StubModel())
+        return {
+            "predict": measure(lambda: predictor.predict("stub", bytes_fp=bytes_fp), repeat),
+            "predict_many": measure(
+                lambda: predictor.predictors["stub"].predict_many(bytes_files), repeat, len(bytes_files)),
+        }
+
+    # every benchmark returns results by name
+    benchmarks = {
+        "byte2np_square": lambda: {"byte2np_square": measure(
+            lambda: rl_utils.byte2np_square(bytes_fp), repeat, 1, os.path.getsize(bytes_fp))},
+        "resize_image": lambda: {"resize_image": measure(
+            lambda: source_utils.resize_image(source_utils.Image.fromarray(matrix)), repeat)},
+        "letterbox_batch": lambda: {"letterbox_batch": measure(
+            lambda: source_utils.letterbox(batch, out=batch_out), repeat, len(batch))},
+        "get_inject_locations": lambda: {"get_inject_locations": measure(
+            lambda: rl_utils.get_inject_locations(asm_fp), repeat, 1, os.path.getsize(asm_fp))},
+        "split_files": lambda: {"split_files": measure(
+            bench_split_files, repeat, len(bytes_files), sum(map(os.path.getsize, bytes_files)))},
+        "env": bench_env,
+        "predict": bench_predict,
+    }
+
+    results = {}
+    for name, bench in benchmarks.items():
+        logger.info(f"Benchmark {name}")
+        try:
+            results.update(bench())
+        except Exception as e:
+            logger.warning(f"Benchmark {name} failed: {e!r}")
+            results[name] = {"error": repr(e)}
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "size": size,
+            "samples_per_family": samples_per_family,
+            "workers": workers,
+        },
+        "benchmarks": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hot paths on a synthetic corpus")
+    parser.add_argument("--size", type=int, default=1 << 18, help="bytes per sample")
+    parser.add_argument("--samples-per-family", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=50, help="env steps per episode")
+    parser.add_argument("--workers", type=int, default=1, help="split_files workers")
+    parser.add_argument("--folder", default=None, help="keep the corpus in this folder")
+    parser.add_argument("--output", default=None, help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run(
+            args.folder or tmp,
+            size=args.size,
+            samples_per_family=args.samples_per_family,
+            repeat=args.repeat,
+            steps=args.steps,
+            workers=args.workers,
+        )
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    print(data)
@@ -0,0 +1,115 @@
+import os
+from typing import (
+    List,
+    Tuple
+)
+
+import numpy as np
+
+from configs import families
+
+
+def generate_bytes(
+        filepath: str,
+        size: int,
+        base_address: int = 0x401000,
+        unknown_ratio: float = 0.01,
+        seed: int = 0,
+) -> np.ndarray:
+    """
+        Write an IDA-style bytes dump of random content
+
+        @size: number of bytes in the dump
+        @unknown_ratio: ratio of bytes written as "??"
+        @return: the bytes written, "??" as 0
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 256, size, dtype=np.uint8)
+    unknown = rng.random(size) < unknown_ratio
+    data[unknown] = 0
+
+    with open(filepath, 'w', newline='') as f:
+        for offset in range(0, size, 16):
+            row = data[offset: offset + 16].tobytes().hex(' ').upper()
+            if unknown[offset: offset + 16].any():
+                tokens = row.split(' ')
+                for i in np.flatnonzero(unknown[offset: offset + 16]):
+                    tokens[i] = "??"
+                row = ' '.join(tokens)
+            f.write(f"{base_address + offset:08X} {row}\r\n")
+    return data
+
+
+def generate_asm(
+        filepath: str,
+        size: int,
+        base_address: int = 0x401000,
+        align_ratio: float = 0.05,
+        sections: Tuple[str, ...] = (".text", ".rdata", ".data"),
+        seed: int = 0,
+) -> List[Tuple[str, int, int]]:
+    """
+        Write an IDA-style asm listing covering size bytes from base_address,
+        with "align" directives followed by gaps of 1 to 15 bytes, the last
+        line has no trailing newline in about half of the listings like some
+        IDA exports
+
+        @align_ratio: ratio of lines which are align directives
+        @return: the (section, address, length) gaps written
+    """
+    rng = np.random.default_rng(seed)
+    locations = []
+    address = base_address
+    end = base_address + size
+    with open(filepath, 'w', newline='') as f:
+        while address < end:
+            # random draws of the next lines at once
+            kinds = rng.random(4096)
+            gaps = rng.integers(1, 16, 4096)
+            lengths = rng.integers(1, 8, 4096)
+            opcodes = rng.integers(0, 256, (4096, 7), dtype=np.uint8)
+            for kind, gap, length, opcode in zip(kinds, gaps, lengths, opcodes):
+                if address >= end:
+                    break
+                section = sections[min((address - base_address) * len(sections) // size, len(sections) - 1)]
+                prefix = f"{section}:{address:08X}"
+                if kind < align_ratio:
+                    gap = int(min(gap, end - address))
+                    f.write(f"{prefix}                 align 10h\r\n")
+                    locations.append((section, address, gap))
+                    address += gap
+                elif kind < align_ratio + 0.1:
+                    f.write(f"{prefix} ; ---------------------------------------------------------------------------\r\n")
+                else:
+                    length = int(min(length, end - address))
+                    f.write(f"{prefix} {opcode[:length].tobytes().hex(' ').upper():<24}\tmov     eax, [ebp+var_4]\r\n")
+                    address += length
+        # IDA listings end with the address following the last byte
+        f.write(f"{sections[-1]}:{end:08X} ; end")
+        if rng.random() < 0.5:
+            f.write("\r\n")
+    return locations
+
+
+def generate_corpus(
+        folder_out: str,
+        samples_per_family: int = 10,
+        size: int = 1 << 20,
+        seed: int = 0,
+) -> Tuple[str, str]:
+    """
+        Write a corpus of bytes files by family with the asm listing of every sample
+
+        @return: (bytes folder by family, asm folder)
+    """
+    bytes_folder = f"{folder_out}/bytes"
+    asm_folder = f"{folder_out}/asm"
+    os.makedirs(asm_folder, exist_ok=True)
+    for family in families:
+        os.makedirs(f"{bytes_folder}/{family}", exist_ok=True)
+        for i in range(samples_per_family):
+            sample_seed = seed * 100000 + family * 1000 + i
+            sample_id = f"synthetic{family}x{i:04d}"
+            generate_bytes(f"{bytes_folder}/{family}/{sample_id}.bytes", size, seed=sample_seed)
+            generate_asm(f"{asm_folder}/{sample_id}.asm", size, seed=sample_seed)
+    return bytes_folder, asm_folder
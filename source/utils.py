@@ -1,4 +1,5 @@
-import itertools
+import hashlib
+import json
 import random
 from loguru import logger
 from typing import (
@@ -9,29 +10,26 @@ from typing import (
 )
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import math
 import numpy as np
 from PIL import Image
 from configs import *
-
-
-def resize_image(image: Image.Image, width: int = 256, height: int = 256) -> Optional[Image.Image]:
-    # resize image keeping aspect ratio
-    image.thumbnail((width, height), Image.ANTIALIAS)
-    
-    # calculate offset to make image in the center
-    w, h = image.size
-    if w < width:
-        offset = ((width - w) // 2, 0)
-    elif h < height:
-        offset = (0, (height - h) // 2)
-    else:
-        offset = (0, 0)
-
-    # add padding
-    new_img = Image.new(image.mode, (width, height))
-    new_img.paste(image, offset)
-    return new_img
+import profiling
+from codec import (
+    iter_bytes_chunks,
+    letterbox,
+    letterbox_offset,
+    load_pyramid,
+    parse_bytes,
+    reshape_square,
+    resize_image,
+    thumbnail_grid,
+)
+from manifest import (
+    load_manifest,
+    save_manifest,
+)
 
 
 def byte2img(filepath: str, width: int = 256, height: int = 256) -> Optional[Image.Image]:
@@ -41,39 +39,17 @@ def byte2img(filepath: str, width: int = 256, height: int = 256) -> Optional[Ima
         @filepath: bytes filepath
     """
     try:
-        with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            print(type(hexstring))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            rem = len(byte_arr) % width
-            byte_arr_len = len(byte_arr) - rem
-            byte_arr = byte_arr[:byte_arr_len]
-            byte_arr = np.asarray(byte_arr)
-            np_arr = np.reshape(byte_arr, (len(byte_arr)//width, width))
-            np_arr = np.uint8(np_arr)
-            img = Image.fromarray(np_arr)
-
-            if width and height:
-                img = resize_image(img, width, height)
-
-            return img
+        byte_arr = parse_bytes(filepath)
+        rem = len(byte_arr) % width
+        byte_arr_len = len(byte_arr) - rem
+        byte_arr = byte_arr[:byte_arr_len]
+        np_arr = np.reshape(byte_arr, (len(byte_arr)//width, width))
+        img = Image.fromarray(np_arr)
+
+        if width and height:
+            img = resize_image(img, width, height)
+
+        return img
     except Exception as error:
         logger.error(f"Cant convert bytes to image: {error}")
 
@@ -85,45 +61,74 @@ def byte2img_square(filepath: str, width: int = 256, height: int = 256):
         @filepath: bytes filepath
     """
     try:
-        with open(filepath, 'r') as f:
-            arr = []
-            for line in f:
-                vals = line.split()
-                del vals[0]
-                arr.append(vals)
-            
-            max_len = max([len(vals) for vals in arr])
-            
-            new_arr = []
-            for vals in arr:
-                new_arr.append([val.replace('?', '0') for val in vals])
-            
-            for vals in new_arr:
-                if '?' in vals:
-                    print(vals)
-            
-            hexstring = ''.join(list(itertools.chain.from_iterable(new_arr)))
-            
-            byte_arr = bytearray.fromhex(hexstring)
-            
-            raw_width = math.floor(math.sqrt(len(byte_arr)))
-            
-            rem = len(byte_arr) % raw_width
-            byte_arr_len = len(byte_arr) - rem
-            byte_arr = byte_arr[:byte_arr_len]
-            byte_arr = np.asarray(byte_arr)
-            np_arr = np.reshape(byte_arr, (len(byte_arr)// raw_width, raw_width))
-            np_arr = np.uint8(np_arr)
-            img = Image.fromarray(np_arr)
-
-            if width and height:
-                img = resize_image(img, width, height)
-
-            return img
+        img = Image.fromarray(reshape_square(parse_bytes(filepath)))
+
+        if width and height:
+            img = resize_image(img, width, height)
+
+        return img
+    except Exception as error:
+        logger.error(f"Cant convert bytes to image: {error}")
+
+
+def byte2img_square_stream(
+        filepath: str,
+        width: int = 256,
+        height: int = 256,
+        chunk_size: int = 1 << 22,
+) -> Optional[Image.Image]:
+    """
+        Convert from bytes to PNG like byte2img_square, without holding the
+        full matrix: bytes are block-averaged into the thumbnail grid chunk
+        by chunk, so memory is bounded by chunk_size
+
+        @filepath: bytes filepath
+    """
+    try:
+        # first pass only counts bytes to get the square dimension
+        total = sum(len(chunk) for chunk in iter_bytes_chunks(filepath, chunk_size))
+        raw_width = math.floor(math.sqrt(total))
+        raw_height = total // raw_width
+        w, h, _, _, counts = thumbnail_grid(raw_height, raw_width, width, height)
+
+        # map every matrix row/column to its cell in the thumbnail grid
+        row_cell = np.arange(raw_height) * h // raw_height
+        col_cell = np.arange(raw_width) * w // raw_width
+        sums = np.zeros(h * w, dtype=np.float64)
+
+        offset = 0
+        size = raw_height * raw_width
+        for chunk in iter_bytes_chunks(filepath, chunk_size):
+            chunk = chunk[:max(size - offset, 0)]
+            if not len(chunk):
+                break
+            rows, cols = np.divmod(np.arange(offset, offset + len(chunk)), raw_width)
+            sums += np.bincount(row_cell[rows] * w + col_cell[cols], weights=chunk, minlength=h * w)
+            offset += len(chunk)
+
+        # same centering as letterbox
+        x, y = letterbox_offset(w, h, width, height)
+        canvas = np.zeros((height, width), dtype=np.uint8)
+        canvas[y: y + h, x: x + w] = np.rint(sums.reshape(h, w) / counts)
+        return Image.fromarray(canvas)
     except Exception as error:
         logger.error(f"Cant convert bytes to image: {error}")
 
 
+def build_pyramid(matrix: np.ndarray, sizes: List[int] = pyramid_sizes) -> Dict[int, np.ndarray]:
+    """
+        Square letterboxed images of a matrix at every size, every level is
+        area-averaged from the matrix itself like a single resize to that size
+    """
+    return {size: letterbox(matrix, size, size) for size in sizes}
+
+
+def save_pyramid(pyramid: Dict[int, np.ndarray], pyramid_fp: str) -> None:
+    with open(f"{pyramid_fp}.tmp", 'wb') as f:
+        np.savez(f, **{str(size): level for size, level in pyramid.items()})
+    os.replace(f"{pyramid_fp}.tmp", pyramid_fp)
+
+
 def generate_folder_out_name(
         root_folder: str,
         splited_percent: SplitedPercent,
@@ -148,18 +153,121 @@ def generate_folder_out_name(
     return folder_out_list
 
 
-def split_files(
+def fingerprint_bytes(byte_arr: np.ndarray, size: int = 16) -> str:
+    """
+        Average hash of a binary for near duplicates: one bit per cell of its
+        size x size thumbnail, set when the cell is above the median, a few
+        changed bytes rarely flip a bit
+    """
+    thumb = letterbox(reshape_square(byte_arr), size, size)
+    return np.packbits(thumb > np.median(thumb)).tobytes().hex()
+
+
+def hash_sample(filepath: str, near_duplicates: bool = False) -> Tuple[str, Optional[str]]:
+    """
+        @return: (hash of the decoded bytes, fingerprint if near_duplicates)
+    """
+    byte_arr = np.ascontiguousarray(parse_bytes(filepath))
+    content_hash = hashlib.blake2b(byte_arr.data, digest_size=16).hexdigest()
+    return content_hash, fingerprint_bytes(byte_arr) if near_duplicates else None
+
+
+def find_duplicates(
+        folder_in: str,
+        hashes: Dict[str, Dict] = None,
+        near_duplicates: bool = False,
+        workers: int = 1,
+        known: set = None,
+) -> Tuple[Dict[str, str], Dict[str, Dict]]:
+    """
+        Group the files of every family by decoded content, the first file of
+        a group by "family/file" is its canonical instance, files of known
+        come first so the canonical instance of a group stays the same when
+        new duplicates are added
+
+        @hashes: hashes of a previous run by "family/file", reused for files
+            whose size and mtime did not change
+        @known: "family/file" of files already split and converted
+        @near_duplicates: group files by fingerprint instead of exact content
+        @return: (canonical "family/file" by duplicate "family/file", hashes by "family/file")
+    """
+    hashes = hashes or {}
+    new_hashes = {}
+    todo = {}
+    for family in families:
+        family_folder = f"{folder_in}/{family}"
+        if not os.path.isdir(family_folder):
+            continue
+        for file in sorted(os.listdir(family_folder)):
+            key = f"{family}/{file}"
+            fp = f"{family_folder}/{file}"
+            stat = os.stat(fp)
+            entry = {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+            old = hashes.get(key)
+            if (
+                old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]
+                and (not near_duplicates or old.get("fingerprint"))
+            ):
+                new_hashes[key] = old
+            else:
+                todo[key] = (fp, entry)
+
+    def update(key, result):
+        fp, entry = todo[key]
+        entry["hash"], entry["fingerprint"] = result
+        new_hashes[key] = entry
+
+    logger.info(f"Hash {len(todo)} files with {workers} workers, {len(new_hashes)} up to date")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(hash_sample, fp, near_duplicates): key for key, (fp, _) in todo.items()}
+            for future in as_completed(futures):
+                try:
+                    update(futures[future], future.result())
+                except Exception as e:
+                    logger.warning(f"Cant hash file {futures[future]}: {e}")
+    else:
+        for key, (fp, _) in todo.items():
+            try:
+                update(key, hash_sample(fp, near_duplicates))
+            except Exception as e:
+                logger.warning(f"Cant hash file {key}: {e}")
+
+    known = known or set()
+    groups = {}
+    for key in sorted(new_hashes, key=lambda key: (key not in known, int(key.split("/")[0]), key)):
+        entry = new_hashes[key]
+        groups.setdefault(entry["fingerprint"] if near_duplicates else entry["hash"], []).append(key)
+
+    aliases = {}
+    for keys in groups.values():
+        for key in keys[1:]:
+            aliases[key] = keys[0]
+        if len({key.split("/")[0] for key in keys}) > 1:
+            logger.warning(f"Duplicates in different families, kept as {keys[0]} - {keys}")
+
+    logger.info(f"Found {len(aliases)} duplicates of {len(groups)} unique files")
+    return aliases, new_hashes
+
+
+def plan_split(
         folder_in: str,
         splited_percent: SplitedPercent,
-        folder_out_list: Dict[str, FolderOutMetadata],
-        width: int = 256,
-        height: int = 256,
-) -> None:
-
-    if not splited_percent.verify():
-        logger.error(f"Invalid splited percentage")
-        return
+        samples: Dict[str, Dict] = None,
+        seed: int = 0,
+        exclude: set = None,
+) -> Optional[List[Tuple[int, str, str]]]:
+    """
+        Shuffle files of every family and assign them to a split
 
+        @samples: manifest entries by "family/file", files already in it keep their split
+        @seed: seed of the shuffle, the same files always get the same splits
+        @exclude: "family/file" of files left out of the split, e.g. duplicates
+        @return: list of (family, split, file)
+    """
+    samples = samples or {}
+    exclude = exclude or set()
+    tasks = []
     for family in families:
         family_folder = f"{folder_in}/{family}"
         if not os.path.isdir(family_folder):
@@ -167,8 +275,11 @@ def split_files(
             return
         
         # list files and get total file
-        family_files = os.listdir(family_folder)
-        random.shuffle(family_files)
+        family_files = sorted(
+            file for file in os.listdir(family_folder)
+            if f"{family}/{file}" not in exclude
+        )
+        random.Random(f"{seed}-{family}").shuffle(family_files)
         total_files = len(family_files)
 
         if splited_percent.train:
@@ -178,7 +289,7 @@ def split_files(
         if splited_percent.valid and no_train_files:
             no_valid_files = int(total_files * splited_percent.valid // 100)
         else:
-            no_test_files = 0
+            no_valid_files = 0
         if splited_percent.test and no_train_files and no_valid_files:
             no_test_files = int(total_files - no_train_files - no_valid_files)
         else:
@@ -189,68 +300,461 @@ def split_files(
             logger.error(f"Unbalanced percentages - {splited_percent.get_percents()}")
             return
 
-        if no_train_files > 0:
-            logger.info(f"Handle train - {family}")
-            for i in range(no_train_files):
-                file = family_files.pop()
-                fp = f"{folder_in}/{family}/{file}"
-                try:
-                    bytes_fp = f"""{folder_out_list["train-bytes"].filepath}/{family}/{file}"""
-                    shutil.copy(fp, bytes_fp)
-                except Exception as e:
-                    logger.warning(f"Cant move file {fp} to {bytes_fp}: {e}")
+        # keep the split of known files, new files fill what is left of each split
+        no_files = dict(zip(splits, (no_train_files, no_valid_files, no_test_files)))
+        family_tasks = []
+        new_files = []
+        for file in family_files:
+            sample = samples.get(f"{family}/{file}")
+            if sample and sample["split"] in splits:
+                family_tasks.append((family, sample["split"], file))
+            else:
+                new_files.append(file)
 
-                try:
-                    img_fp = f"""{folder_out_list["train-img"].filepath}/{family}/{file}.png"""
-                    img = byte2img_square(fp, width, height)
-                    img.save(img_fp)
-                except Exception as e:
-                    logger.warning(f"Cant convert bytes to image: {fp} - {e}")
-            logger.success(f"Handle train - {family} successfully - {no_train_files}/{total_files}")
+        for split in splits:
+            no_files_left = no_files[split] - sum(t[1] == split for t in family_tasks)
+            for i in range(min(max(no_files_left, 0), len(new_files))):
+                family_tasks.append((family, split, new_files.pop()))
+            if not no_files[split]:
+                logger.warning(f"Empty {split} files - {family}")
+
+        tasks.extend(family_tasks)
+
+    return tasks
+
+
+def place_file(src: str, dst: str, link_mode: str = "copy") -> None:
+    """
+        Place a file of the source dataset in a split folder
+
+        @link_mode: one of link_modes, "index" places nothing and the
+            split only lives in its manifest
+    """
+    if link_mode == "index":
+        return
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link_mode == "hardlink":
+        os.link(src, dst)
+    elif link_mode == "symlink":
+        os.symlink(os.path.realpath(src), dst)
+    else:
+        shutil.copy(src, dst)
+
+
+def convert_file(
+        fp: str,
+        bytes_fp: str,
+        img_fp: str,
+        width: int = 256,
+        height: int = 256,
+        chunk_size: int = None,
+        link_mode: str = "copy",
+        save_png: bool = True,
+        keep_image: bool = False,
+        pyramid_fp: str = None,
+        pyramid_sizes: List[int] = None,
+) -> Tuple[bool, Optional[np.ndarray]]:
+    """
+        Place a bytes file in its split folder and save its image
+
+        @save_png: write the image to img_fp
+        @keep_image: also return the image array, for shard export
+        @pyramid_fp: also save the images at pyramid_sizes to this .npz, from the
+            same decoded matrix, chunk_size is ignored then
+        @return: (True if both steps succeeded, image array if keep_image)
+    """
+    success = True
+    img_np = None
+    try:
+        with profiling.timer(f"place_file_{link_mode}"):
+            place_file(fp, bytes_fp, link_mode)
+    except Exception as e:
+        logger.warning(f"Cant move file {fp} to {bytes_fp}: {e}")
+        success = False
+
+    try:
+        if pyramid_fp:
+            matrix = reshape_square(parse_bytes(fp))
+            pyramid = build_pyramid(matrix, pyramid_sizes)
+            if width == height and width in pyramid:
+                img = Image.fromarray(pyramid[width])
+            else:
+                img = Image.fromarray(letterbox(matrix, width, height))
+            with profiling.timer("pyramid_save"):
+                save_pyramid(pyramid, pyramid_fp)
+        elif chunk_size:
+            img = byte2img_square_stream(fp, width, height, chunk_size)
         else:
-            logger.warning("Empty train files")
+            img = byte2img_square(fp, width, height)
+        if save_png:
+            with profiling.timer("png_encode"):
+                img.save(img_fp)
+        if keep_image:
+            img_np = np.asarray(img)
+    except Exception as e:
+        logger.warning(f"Cant convert bytes to image: {fp} - {e}")
+        success = False
 
-        if no_valid_files > 0:
-            logger.info(f"Handle valid - {family}")
-            for i in range(no_valid_files):
-                file = family_files.pop()
-                fp = f"{folder_in}/{family}/{file}"
-                try:
-                    bytes_fp = f"""{folder_out_list["valid-bytes"].filepath}/{family}/{file}"""
-                    shutil.copy(fp, bytes_fp)
-                except Exception as e:
-                    logger.warning(f"Cant move file {fp} to {bytes_fp}: {e}")
+    profiling.count("files_converted" if success else "files_failed")
+    return success, img_np
 
-                try:
-                    img_fp = f"""{folder_out_list["valid-img"].filepath}/{family}/{file}.png"""
-                    img = byte2img_square(fp, width, height)
-                    img.save(img_fp)
-                except Exception as e:
-                    logger.warning(f"Cant convert bytes to image: {fp} - {e}")
-            logger.success(f"Handle valid - {family} successfully - {no_valid_files}/{total_files}")
+
+class ShardWriter:
+    """
+        Write the images of a split as a few large .npy shards which can be
+        read sequentially or memory-mapped, with their families and ids:
+
+            {split}-{n:05d}.images.npy  (count, height, width) uint8
+            {split}-{n:05d}.labels.npy  (count,) family
+
+        @shard_size: max number of images per shard
+    """
+
+    def __init__(self, shard_folder: str, split: str, shard_size: int = 4096, width: int = 256, height: int = 256):
+        self.shard_folder = shard_folder
+        self.split = split
+        self.shard_size = shard_size
+        self.width = width
+        self.height = height
+        self.shards = []
+        self.images = None
+        self.labels = []
+        self.ids = []
+
+    def add(self, sample_id: str, family: int, image: np.ndarray) -> None:
+        if self.images is None:
+            name = f"{self.split}-{len(self.shards):05d}"
+            self.images = np.lib.format.open_memmap(
+                f"{self.shard_folder}/{name}.images.npy", mode='w+',
+                dtype=np.uint8, shape=(self.shard_size, self.height, self.width),
+            )
+        self.images[len(self.ids)] = image
+        self.labels.append(family)
+        self.ids.append(sample_id)
+        if len(self.ids) == self.shard_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.images is None:
+            return
+
+        name = f"{self.split}-{len(self.shards):05d}"
+        images_fp = f"{self.shard_folder}/{name}.images.npy"
+        count = len(self.ids)
+        if count < self.shard_size:
+            # last shard of the split, rewritten to its real length
+            images = np.lib.format.open_memmap(
+                f"{images_fp}.tmp", mode='w+', dtype=np.uint8, shape=(count, self.height, self.width),
+            )
+            images[:] = self.images[:count]
+            images.flush()
+            del images
+            self.images = None
+            os.replace(f"{images_fp}.tmp", images_fp)
         else:
-            logger.warning("Empty valid files")
+            self.images.flush()
+            self.images = None
+        np.save(f"{self.shard_folder}/{name}.labels.npy", np.array(self.labels, dtype=np.int16))
+
+        self.shards.append({
+            "images": f"{name}.images.npy",
+            "labels": f"{name}.labels.npy",
+            "count": count,
+            "ids": self.ids,
+        })
+        self.labels = []
+        self.ids = []
+
+    def close(self) -> List[Dict]:
+        self.flush()
+        return self.shards
+
+
+def write_shard_index(shard_folder: str, writers: Dict[str, ShardWriter], width: int, height: int) -> str:
+    index_fp = f"{shard_folder}/shards.json"
+    index = {
+        "width": width,
+        "height": height,
+        "splits": {split: writer.close() for split, writer in writers.items()},
+    }
+    with open(f"{index_fp}.tmp", 'w') as f:
+        json.dump(index, f)
+    os.replace(f"{index_fp}.tmp", index_fp)
+    return index_fp
+
+
+def load_shard_images(shard_folder: str) -> Dict[Tuple[int, str], np.ndarray]:
+    """
+        Images of the shards indexed by {shard_folder}/shards.json, memory-mapped
 
-        if no_test_files > 0:
-            logger.info(f"Handle test - {family}")
-            for i in range(no_test_files):
-                file = family_files.pop()
-                fp = f"{folder_in}/{family}/{file}"
-                try:
-                    bytes_fp = f"""{folder_out_list["test-bytes"].filepath}/{family}/{file}"""
-                    shutil.copy(fp, bytes_fp)
-                except Exception as e:
-                    logger.warning(f"Cant move file {fp} to {bytes_fp}: {e}")
+        @return: image by (family, id), empty if there is no readable index
+    """
+    index_fp = f"{shard_folder}/shards.json"
+    if not os.path.isfile(index_fp):
+        return {}
+
+    images = {}
+    try:
+        with open(index_fp, 'r') as f:
+            index = json.load(f)
+        for shards in index["splits"].values():
+            for shard in shards:
+                shard_images = np.load(f"{shard_folder}/{shard['images']}", mmap_mode='r')
+                labels = np.load(f"{shard_folder}/{shard['labels']}")
+                for image, family, sample_id in zip(shard_images, labels, shard["ids"]):
+                    images[(int(family), sample_id)] = image
+    except Exception as e:
+        logger.warning(f"Cant read shards of {shard_folder}: {e}")
+        return {}
+    return images
+
+
+def remove_outputs(sample: Dict) -> None:
+    """
+        Remove what split_files wrote for a manifest entry, the source file is kept
+    """
+    outputs = [sample.get("img_fp"), sample.get("pyramid_fp")]
+    if sample.get("bytes_fp") != sample.get("source_fp"):
+        outputs.append(sample.get("bytes_fp"))
+    for fp in outputs:
+        if fp and os.path.lexists(fp):
+            os.remove(fp)
+
+
+def load_output_image(sample: Dict, width: int = 256, height: int = 256) -> Optional[np.ndarray]:
+    """
+        Read back the image split_files saved for a manifest entry, from its PNG
+        or else from the width level of its pyramid
+
+        @return: (height, width) uint8 image, None if no saved image has this size
+    """
+    try:
+        if sample.get("img_fp") and os.path.isfile(sample["img_fp"]):
+            with Image.open(sample["img_fp"]) as img:
+                img_np = np.asarray(img)
+        elif width == height and sample.get("pyramid_fp") and os.path.isfile(sample["pyramid_fp"]):
+            img_np = load_pyramid(sample["pyramid_fp"], width)
+        else:
+            return None
+    except Exception as e:
+        logger.warning(f"Cant read image of {sample['source_fp']}: {e}")
+        return None
+    return img_np if img_np.shape == (height, width) else None
+
+
+def split_files(
+        folder_in: str,
+        splited_percent: SplitedPercent,
+        folder_out_list: Dict[str, FolderOutMetadata],
+        width: int = 256,
+        height: int = 256,
+        chunk_size: int = None,
+        workers: int = 1,
+        progress_every: int = 100,
+        manifest_fp: str = None,
+        seed: int = 0,
+        link_mode: str = "copy",
+        shard_size: int = 0,
+        save_png: bool = True,
+        pyramid_sizes: List[int] = None,
+        dedup: bool = False,
+        near_duplicates: bool = False,
+) -> Optional[Dict[int, Dict[str, Dict[str, int]]]]:
+    """
+        Split bytes files of every family into train/valid/test and convert them to images
+
+        @chunk_size: stream big bytes files by chunks of this size instead of decoding them at once
+        @workers: number of processes converting files, files of all families and splits are
+            handled as independent tasks
+        @progress_every: log progress every this many files
+        @manifest_fp: manifest of the split, files already converted and unchanged since are
+            skipped and the manifest is saved as files are converted so a stopped run resumes
+        @seed: seed of the split shuffle
+        @link_mode: how bytes files are placed in the split folders: "copy", "hardlink",
+            "symlink" or "index" to only reference the source files from the manifest
+        @shard_size: also export the images of every split as .npy shards of this many images
+            in {folder_out}/shards, see ShardWriter, up to date files are read back from their
+            PNG, pyramid or previous shards instead of being converted again
+        @save_png: write one PNG per file, can be disabled when exporting shards
+        @pyramid_sizes: also save the images of every file at these sizes, e.g. pyramid_sizes
+            of configs, to {file}.pyramid.npz next to its PNG, see load_pyramid
+        @dedup: only split and convert one canonical instance of files with the same
+            decoded bytes, duplicates are recorded as aliases in the manifest with the
+            split of their canonical file, see find_duplicates
+        @near_duplicates: with dedup, also group files with the same fingerprint
+        @return: success/failure counts by family and split
+    """
+
+    if not splited_percent.verify():
+        logger.error(f"Invalid splited percentage")
+        return
+
+    if link_mode not in link_modes:
+        logger.error(f"Invalid link mode {link_mode} - {link_modes}")
+        return
+
+    if not save_png and not shard_size:
+        logger.error(f"Images are neither saved as PNG nor exported to shards")
+        return
+
+    manifest = load_manifest(manifest_fp)
+    aliases = {}
+    if dedup:
+        aliases, manifest["hashes"] = find_duplicates(
+            folder_in, manifest.get("hashes"), near_duplicates, workers, set(manifest["samples"]),
+        )
+        # files which became duplicates leave their split folders
+        for key in aliases:
+            if key in manifest["samples"]:
+                remove_outputs(manifest["samples"][key])
+    tasks = plan_split(folder_in, splited_percent, manifest["samples"], seed, set(aliases))
+    if tasks is None:
+        return
 
+    # refresh manifest entries and keep only files which need a conversion
+    samples = {}
+    todo = []
+    for family, split, file in tasks:
+        key = f"{family}/{file}"
+        fp = os.path.abspath(f"{folder_in}/{family}/{file}")
+        stat = os.stat(fp)
+        sample = {
+            "id": file.replace(".bytes", ""),
+            "family": family,
+            "split": split,
+            "source_fp": fp,
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+            "bytes_fp": fp if link_mode == "index" else f"""{folder_out_list[f"{split}-bytes"].filepath}/{family}/{file}""",
+            "img_fp": f"""{folder_out_list[f"{split}-img"].filepath}/{family}/{file}.png""" if save_png else None,
+            "pyramid_fp": f"""{folder_out_list[f"{split}-img"].filepath}/{family}/{file}.pyramid.npz""" if pyramid_sizes else None,
+            "done": False,
+        }
+        old = manifest["samples"].get(key)
+        if (
+            old and old["done"]
+            and all(old.get(k) == sample[k] for k in ("split", "size", "mtime", "bytes_fp", "img_fp", "pyramid_fp"))
+            and os.path.isfile(sample["bytes_fp"])
+            and (not save_png or os.path.isfile(sample["img_fp"]))
+            and (not pyramid_sizes or os.path.isfile(sample["pyramid_fp"]))
+        ):
+            sample["done"] = True
+        else:
+            todo.append(key)
+        samples[key] = sample
+
+    # files removed from folder_in leave their split folders
+    for key, old in manifest["samples"].items():
+        if key not in samples and key not in aliases:
+            remove_outputs(old)
+
+    manifest["seed"] = seed
+    manifest["percents"] = splited_percent.get_percents()
+    manifest["samples"] = samples
+    # duplicates follow the split of their canonical file
+    manifest["aliases"] = {
+        key: {
+            "canonical": canonical,
+            "family": int(key.split("/")[0]),
+            "split": samples[canonical]["split"] if canonical in samples else None,
+        }
+        for key, canonical in aliases.items()
+    }
+    if manifest_fp:
+        save_manifest(manifest, manifest_fp)
+
+    stats = {
+        family: {split: {"success": 0, "failure": 0} for split in splits}
+        for family in families
+    }
+
+    shard_folder = None
+    writers = {}
+    if shard_size:
+        shard_folder = f"""{os.path.dirname(folder_out_list["train-img"].filepath)}/shards"""
+        # shards of the previous run are moved aside and read back while new shards
+        # are written with the same names, a stopped run leaves them there
+        previous_folder = f"{shard_folder}.previous"
+        if os.path.isfile(f"{shard_folder}/shards.json"):
+            shutil.rmtree(previous_folder, ignore_errors=True)
+            os.replace(shard_folder, previous_folder)
+        previous_images = load_shard_images(previous_folder)
+        os.makedirs(shard_folder, exist_ok=True)
+        writers = {split: ShardWriter(shard_folder, split, shard_size, width, height) for split in splits}
+
+        # up to date files go to the shards from their saved images or previous shards,
+        # files without a readable image of the shard size are converted again
+        for key, sample in samples.items():
+            if not sample["done"]:
+                continue
+            img_np = load_output_image(sample, width, height)
+            if img_np is None:
+                img_np = previous_images.get((sample["family"], sample["id"]))
+            if img_np is None or img_np.shape != (height, width):
+                sample["done"] = False
+                todo.append(key)
+            else:
+                writers[sample["split"]].add(sample["id"], sample["family"], img_np)
+
+    def task_args(key):
+        sample = samples[key]
+        return (
+            sample["source_fp"], sample["bytes_fp"], sample["img_fp"], width, height,
+            chunk_size, link_mode, save_png, bool(shard_size),
+            sample["pyramid_fp"], pyramid_sizes,
+        )
+
+    def update(key, result, done):
+        success, img_np = result
+        sample = samples[key]
+        sample["done"] = success
+        if shard_size and img_np is not None:
+            writers[sample["split"]].add(sample["id"], sample["family"], img_np)
+        stats[sample["family"]][sample["split"]]["success" if success else "failure"] += 1
+        if done % progress_every == 0 or done == len(todo):
+            logger.info(f"Handled {done}/{len(todo)} files")
+            if manifest_fp:
+                save_manifest(manifest, manifest_fp)
+
+    logger.info(f"Handle {len(todo)} files with {workers} workers, {len(samples) - len(todo)} up to date")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(convert_file, *task_args(key)): key
+                for key in todo
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                key = futures[future]
                 try:
-                    img_fp = f"""{folder_out_list["test-img"].filepath}/{family}/{file}.png"""
-                    img = byte2img_square(fp, width, height)
-                    img.save(img_fp)
+                    result = future.result()
                 except Exception as e:
-                    logger.warning(f"Cant convert bytes to image: {fp} - {e}")
-            logger.success(f"Handle test - {family} successfully - {no_test_files}/{total_files}")
-        else:
-            logger.warning("Empty test files")
+                    logger.warning(f"Cant handle file {key}: {e}")
+                    result = (False, None)
+                update(key, result, done)
+    else:
+        for done, key in enumerate(todo, 1):
+            update(key, convert_file(*task_args(key)), done)
+
+    for family in families:
+        for split in splits:
+            count = stats[family][split]
+            if count["success"] + count["failure"]:
+                logger.success(
+                    f"Handle {split} - {family} - {count['success']} succeeded, {count['failure']} failed"
+                )
+
+    if shard_size:
+        index_fp = write_shard_index(shard_folder, writers, width, height)
+        previous_images.clear()
+        shutil.rmtree(previous_folder, ignore_errors=True)
+        manifest["shards"] = index_fp
+        if manifest_fp:
+            save_manifest(manifest, manifest_fp)
+        logger.success(f"Exported shards to {index_fp}")
+
+    return stats
 
 
 def generate_dataset(
@@ -258,7 +762,22 @@ def generate_dataset(
         train: float,
         valid: float,
         test: float = 0.0,
-) -> None:
+        chunk_size: int = None,
+        workers: int = 1,
+        seed: int = 0,
+        link_mode: str = "copy",
+        shard_size: int = 0,
+        save_png: bool = True,
+        pyramid_sizes: List[int] = None,
+        dedup: bool = False,
+        near_duplicates: bool = False,
+) -> Optional[Dict[int, Dict[str, Dict[str, int]]]]:
+    """
+        Split and convert a dataset, the manifest of the split is kept in
+        its folder so reruns only convert new or changed files
+
+        @folder_in: folder of bytes files by family
+    """
     # initialize
     root_folder = os.path.dirname(os.path.realpath(folder_in))
     
@@ -272,34 +791,61 @@ def generate_dataset(
         root_folder=root_folder,
         splited_percent=splited_percent,
     )
-    split_files(
+    folder_out = os.path.dirname(folder_out_list["train-img"].filepath)
+    return split_files(
         folder_in=folder_in,
         folder_out_list=folder_out_list,
         splited_percent=splited_percent,
+        chunk_size=chunk_size,
+        workers=workers,
+        manifest_fp=f"{folder_out}/manifest.json",
+        seed=seed,
+        link_mode=link_mode,
+        shard_size=shard_size,
+        save_png=save_png,
+        pyramid_sizes=pyramid_sizes,
+        dedup=dedup,
+        near_duplicates=near_duplicates,
     )
 
 
 def get_asm_files(
     folder_in: str,
     folder_out: str,
+    asm_folder: str = "/home/unibna/thesis/source/dataset/train-asm",
+    link_mode: str = "copy",
 ) -> None:
+    """
+        Place asm files of the bytes files in folder_in by family
+
+        @asm_folder: folder of all asm files
+        @link_mode: one of link_modes, with "index" only {folder_out}/index.json is written,
+            the RL environment resolves asm files through it, see load_asm_index
+    """
 
     if not os.path.isdir(folder_out):
         os.mkdir(folder_out)
 
+    index = {}
     for family in families:
         family_folder_in = f"{folder_in}/{family}"
         family_folder_out = f"{folder_out}/{family}"
 
-        if not os.path.isdir(family_folder_out):
+        if link_mode != "index" and not os.path.isdir(family_folder_out):
             os.mkdir(family_folder_out)
 
         files = os.listdir(family_folder_in)
+        index[family] = []
         for file in files:
             file = file.replace(".bytes", ".asm")
-            src = f"/home/unibna/thesis/source/dataset/train-asm/{file}"
+            src = f"{asm_folder}/{file}"
             dst = f"{family_folder_out}/{file}"
-            shutil.copy(src, dst)
+            place_file(src, dst, link_mode)
+            index[family].append(src)
+
+    if link_mode == "index":
+        with open(f"{folder_out}/index.json", 'w') as f:
+            json.dump(index, f, indent=1)
 
 
 def get_test_sample(train_folder, family=3):
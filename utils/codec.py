@@ -0,0 +1,384 @@
+"""
+    Decoding of IDA hex dumps (.bytes) and their area-averaged thumbnails,
+    shared by the dataset generation in source/ and the RL environment in RL/
+"""
+
+import json
+import math
+import os
+from loguru import logger
+from typing import (
+    Dict,
+    Iterator,
+    Optional,
+    Tuple
+)
+
+import numpy as np
+from PIL import Image
+
+import profiling
+
+
+# lookup table from ascii code to hex nibble, 0xFF marks separators
+# unknown bytes ("??") are mapped to 0 like the original hex dump parser
+HEX_NIBBLES = np.full(256, 0xFF, dtype=np.uint8)
+for _i, _c in enumerate(b"0123456789abcdef"):
+    HEX_NIBBLES[_c] = _i
+    HEX_NIBBLES[ord(chr(_c).upper())] = _i
+HEX_NIBBLES[ord("?")] = 0
+
+
+def decode_hexdump(buf: bytes) -> np.ndarray:
+    """
+        Decode the text of an IDA hex dump to raw bytes
+
+        @buf: content of the dump, the first token of every line is the address
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    nibbles = HEX_NIBBLES[data]
+
+    # locate every token as a run of hex characters
+    is_token = (nibbles != 0xFF).astype(np.int8)
+    edges = np.diff(is_token, prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if not len(starts):
+        return np.empty(0, dtype=np.uint8)
+
+    # drop the address column: first token of each line
+    lines = np.searchsorted(np.flatnonzero(data == ord("\n")), starts)
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = lines[1:] != lines[:-1]
+    keep = ~first & ((ends - starts) == 2)
+
+    starts = starts[keep]
+    return (nibbles[starts] << 4) | nibbles[starts + 1]
+
+
+def decode_bytes_file(filepath: str, chunk_size: int = 1 << 22) -> np.ndarray:
+    """
+        Decode a bytes file chunk by chunk into one preallocated array, so
+        the temporaries of decode_hexdump are bounded by chunk_size
+
+        @filepath: bytes filepath
+    """
+    # every byte takes at least 3 characters ("XX "), size // 3 bounds the output
+    out = np.empty(os.path.getsize(filepath) // 3 + 1, dtype=np.uint8)
+    length = 0
+    for chunk in iter_bytes_chunks(filepath, chunk_size):
+        out[length: length + len(chunk)] = chunk
+        length += len(chunk)
+    out.resize(length, refcheck=False)
+    return out
+
+
+def read_base_address(filepath: str) -> int:
+    with open(filepath, 'r') as f:
+        return int(f.readline().split()[0], 16)
+
+
+class BinaryCorpus:
+    """
+        Decoded bytes of a whole corpus packed in one memory-mapped file
+
+        @corpus_fp: corpus path without extension, data is stored in
+            {corpus_fp}.bin and the index in {corpus_fp}.json
+    """
+
+    def __init__(self, corpus_fp: str):
+        self.corpus_fp = corpus_fp
+        with open(f"{corpus_fp}.json", 'r') as f:
+            self.samples = json.load(f)["samples"]
+
+        if os.path.getsize(f"{corpus_fp}.bin"):
+            self.data = np.memmap(f"{corpus_fp}.bin", dtype=np.uint8, mode='r')
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
+
+    @staticmethod
+    def sample_id(filepath: str) -> str:
+        return os.path.basename(filepath).replace(".bytes", "")
+
+    def lookup(self, filepath: str) -> Optional[Dict]:
+        """
+            Get the index entry of a sample, None if it is not packed or
+            the bytes file was modified after packing
+
+            @filepath: bytes filepath or sample id
+        """
+        sample = self.samples.get(self.sample_id(filepath))
+        if sample is None:
+            return None
+
+        if os.path.isfile(filepath):
+            stat = os.stat(filepath)
+            if stat.st_size != sample["size"] or int(stat.st_mtime) != sample["mtime"]:
+                return None
+        return sample
+
+    def get(self, filepath: str) -> Optional[np.ndarray]:
+        sample = self.lookup(filepath)
+        if sample is None:
+            return None
+        return self.data[sample["offset"]: sample["offset"] + sample["length"]]
+
+
+# corpus used by the loaders when it is loaded
+corpus: Optional[BinaryCorpus] = None
+
+
+def load_corpus(corpus_fp: str) -> BinaryCorpus:
+    """
+        Load a packed corpus, bytes files found in it are not parsed anymore
+
+        @corpus_fp: corpus path without extension
+    """
+    global corpus
+    if corpus is None or corpus.corpus_fp != corpus_fp:
+        corpus = BinaryCorpus(corpus_fp)
+        logger.info(f"Loaded corpus {corpus_fp} - {len(corpus.samples)} samples")
+    return corpus
+
+
+def pack_corpus(folder_in: str, corpus_fp: str) -> Dict[str, Dict]:
+    """
+        Decode every bytes file under a folder once and pack them into
+        {corpus_fp}.bin with the index in {corpus_fp}.json
+
+        @folder_in: folder of bytes files, searched recursively
+        @corpus_fp: corpus path without extension
+    """
+    samples = {}
+    offset = 0
+    with open(f"{corpus_fp}.bin.tmp", 'wb') as f:
+        for root, _, files in os.walk(folder_in):
+            for file in sorted(files):
+                if not file.endswith(".bytes"):
+                    continue
+
+                fp = os.path.join(root, file)
+                try:
+                    byte_arr = decode_bytes_file(fp)
+                    base_address = read_base_address(fp)
+                except Exception as e:
+                    logger.warning(f"Cant pack file {fp}: {e}")
+                    continue
+
+                stat = os.stat(fp)
+                samples[BinaryCorpus.sample_id(fp)] = {
+                    "family": os.path.basename(root),
+                    "offset": offset,
+                    "length": len(byte_arr),
+                    "base_address": base_address,
+                    "size": stat.st_size,
+                    "mtime": int(stat.st_mtime),
+                }
+                byte_arr.tofile(f)
+                offset += len(byte_arr)
+
+    with open(f"{corpus_fp}.json.tmp", 'w') as f:
+        json.dump({"samples": samples}, f)
+    os.replace(f"{corpus_fp}.bin.tmp", f"{corpus_fp}.bin")
+    os.replace(f"{corpus_fp}.json.tmp", f"{corpus_fp}.json")
+
+    logger.success(f"Packed {len(samples)} samples into {corpus_fp} - {offset} bytes")
+    return samples
+
+
+def parse_bytes(filepath: str) -> np.ndarray:
+    """
+        Parse bytes file to a flat uint8 array, read from the loaded
+        corpus without copy when the sample is packed
+
+        @filepath: bytes filepath
+    """
+    if corpus is not None:
+        byte_arr = corpus.get(filepath)
+        if byte_arr is not None:
+            profiling.count("corpus_hits")
+            return byte_arr
+    return decode_bytes_file(filepath)
+
+
+def get_base_address(filepath: str) -> int:
+    """
+        Get the address of the first byte in bytes file
+
+        @filepath: bytes filepath
+    """
+    if corpus is not None:
+        sample = corpus.lookup(filepath)
+        if sample is not None:
+            return sample["base_address"]
+    return read_base_address(filepath)
+
+
+def reshape_square(byte_arr: np.ndarray) -> np.ndarray:
+    """
+        Reshape a flat byte array to a nearly square matrix, dropping the
+        trailing bytes that do not fill a whole row
+    """
+    raw_width = math.floor(math.sqrt(len(byte_arr)))
+
+    rem = len(byte_arr) % raw_width
+    byte_arr_len = len(byte_arr) - rem
+    byte_arr = byte_arr[:byte_arr_len]
+    return np.reshape(byte_arr, (len(byte_arr)// raw_width, raw_width))
+
+
+def iter_bytes_chunks(filepath: str, chunk_size: int = 1 << 22) -> Iterator[np.ndarray]:
+    """
+        Decode a bytes file chunk by chunk, chunks are cut at line ends
+
+        @filepath: bytes filepath
+        @chunk_size: number of text bytes read at once
+    """
+    rest = b""
+    with open(filepath, 'rb') as f:
+        while True:
+            buf = f.read(chunk_size)
+            if not buf:
+                break
+            buf = rest + buf
+            end = buf.rfind(b"\n") + 1
+            rest = buf[end:]
+            if end:
+                with profiling.timer("hex_decode"):
+                    chunk = decode_hexdump(memoryview(buf)[:end])
+                profiling.count("bytes_decoded", len(chunk))
+                yield chunk
+    if rest:
+        with profiling.timer("hex_decode"):
+            chunk = decode_hexdump(rest)
+        profiling.count("bytes_decoded", len(chunk))
+        yield chunk
+
+
+def thumbnail_size(w: int, h: int, width: int, height: int) -> Tuple[int, int]:
+    """
+        Size of a w x h image after PIL thumbnail to (width, height)
+    """
+    if width >= w and height >= h:
+        return w, h
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = w / h
+    if width / height >= aspect:
+        width = round_aspect(height * aspect, key=lambda n: abs(aspect - n / height))
+    else:
+        height = round_aspect(width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - width / n))
+    return width, height
+
+
+def letterbox_offset(w: int, h: int, width: int, height: int) -> Tuple[int, int]:
+    """
+        (x, y) of a w x h thumbnail centered in a width x height image
+    """
+    if w < width:
+        return (width - w) // 2, 0
+    elif h < height:
+        return 0, (height - h) // 2
+    return 0, 0
+
+
+def thumbnail_grid(rows: int, cols: int, width: int, height: int):
+    """
+        Cells of the thumbnail of a rows x cols matrix, every thumbnail pixel
+        is the mean of a block of consecutive rows and columns
+
+        @return: (w, h, first row of every cell row, first column of every
+            cell column, (h, w) number of matrix values per cell)
+    """
+    w, h = thumbnail_size(cols, rows, width, height)
+    row_cell = np.arange(rows) * h // rows
+    col_cell = np.arange(cols) * w // cols
+    row_starts = np.flatnonzero(np.diff(row_cell, prepend=-1))
+    col_starts = np.flatnonzero(np.diff(col_cell, prepend=-1))
+    counts = np.outer(np.bincount(row_cell, minlength=h), np.bincount(col_cell, minlength=w))
+    return w, h, row_starts, col_starts, counts
+
+
+def block_sum(matrices: np.ndarray, starts: np.ndarray, axis: int) -> np.ndarray:
+    """
+        Sums of the blocks of consecutive slices starting at starts along axis,
+        as uint32; blocks only have 1 or 2 distinct sizes in a thumbnail grid so
+        whole slices are added at once instead of reducing every small block
+
+        @starts: first index of every block, the last block ends at the end of axis
+    """
+    sizes = np.diff(np.append(starts, matrices.shape[axis]))
+    matrices = np.moveaxis(matrices, axis, 0)
+    sums = matrices[starts].astype(np.uint32)
+    k = sizes.min()
+    for j in range(1, k):
+        sums += matrices[starts + j]
+    for j in range(k, sizes.max()):
+        longer = np.flatnonzero(sizes > j)
+        sums[longer] += matrices[starts[longer] + j]
+    return np.moveaxis(sums, 0, axis)
+
+
+def letterbox(
+        matrices: np.ndarray,
+        width: int = 256,
+        height: int = 256,
+        out: np.ndarray = None,
+) -> np.ndarray:
+    """
+        Area-averaged thumbnail of a matrix keeping its aspect ratio, padded
+        with zeros to width x height and centered like the PIL thumbnail + paste
+        it replaces, matrices smaller than the output are only padded
+
+        @matrices: (rows, cols) matrix or (N, rows, cols) batch of matrices
+        @out: preallocated uint8 output of shape (height, width) or (N, height, width)
+        @return: out
+    """
+    with profiling.timer("resize"):
+        matrices = np.asarray(matrices)
+        batch = matrices.ndim == 3
+        if not batch:
+            matrices = matrices[np.newaxis]
+        n, rows, cols = matrices.shape
+
+        if out is None:
+            out = np.zeros((n, height, width) if batch else (height, width), dtype=np.uint8)
+        else:
+            out[...] = 0
+        thumbs = out if batch else out[np.newaxis]
+
+        w, h, row_starts, col_starts, counts = thumbnail_grid(rows, cols, width, height)
+        x, y = letterbox_offset(w, h, width, height)
+        sums = block_sum(block_sum(matrices, row_starts, 1), col_starts, 2)
+        thumbs[:, y: y + h, x: x + w] = np.rint(sums / counts)
+        return out
+
+
+def resize_image(image: Image.Image, width: int = 256, height: int = 256) -> Optional[Image.Image]:
+    """
+        Resize image keeping aspect ratio and pad it to width x height,
+        the image is centered, see letterbox
+    """
+    np_arr = np.asarray(image)
+    if np_arr.ndim == 2:
+        return Image.fromarray(letterbox(np_arr, width, height), image.mode)
+
+    # every channel is resized as a matrix of the batch
+    channels = letterbox(np.moveaxis(np_arr, -1, 0), width, height)
+    return Image.fromarray(np.ascontiguousarray(np.moveaxis(channels, 0, -1)), image.mode)
+
+
+def load_pyramid(pyramid_fp: str, size: int = None):
+    """
+        Load the images of a sample saved by split_files in source/utils.py
+        with pyramid_sizes
+
+        @size: only load this level
+        @return: (size, size) uint8 image, or images by size
+    """
+    with np.load(pyramid_fp) as levels:
+        if size is not None:
+            return levels[str(size)]
+        return {int(key): levels[key] for key in levels.files}
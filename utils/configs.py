@@ -28,6 +28,9 @@ class SplitedPercent:
         return True
 
 families = [i for i in range(1,10)]
+splits = ["train", "valid", "test"]
+link_modes = ["copy", "hardlink", "symlink", "index"]
+pyramid_sizes = [512, 256, 128, 64]
 folder_out_list = {
     "train-bytes": FolderOutMetadata(),
     "valid-bytes": FolderOutMetadata(),
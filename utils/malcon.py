@@ -1,11 +1,13 @@
 
 import os
+import json
 import time
 import datetime
 import numpy as np
 from PIL import Image
 import cv2
 
+import tensorflow as tf
 import keras.preprocessing
 from keras.models import Sequential, load_model
 from keras.preprocessing.image import ImageDataGenerator
@@ -13,6 +15,8 @@ from keras.layers import Conv2D, MaxPooling2D
 from keras.layers import Activation, Dropout, Flatten, Dense
 
 import utils
+from codec import load_pyramid
+from configs import families
 
 
 class MalwareConvNet:
@@ -29,6 +33,16 @@ class MalwareConvNet:
     pool_size = (2, 2)
     num_classes = 9
 
+    def __init__(self, grayscale: bool = False):
+        """
+            @grayscale: keep byte images on a single channel from decoding to
+                the model input instead of repeating them on 3 channels
+        """
+        self.grayscale = grayscale
+        if grayscale:
+            self.img_size = (256, 256, 1)
+            self.input_shape = (256, 256, 1)
+
     def generate_data(self, train_folder: str, test_folder: str):
         image_generator = ImageDataGenerator(rescale=1/255, validation_split=0.2)    
 
@@ -36,6 +50,7 @@ class MalwareConvNet:
                                                         directory=train_folder,
                                                         shuffle=True,
                                                         target_size=(256, 256), 
+                                                        color_mode="grayscale" if self.grayscale else "rgb",
                                                         subset="training",
                                                         class_mode='categorical')
         
@@ -43,9 +58,173 @@ class MalwareConvNet:
                                                         directory=test_folder,
                                                         shuffle=True,
                                                         target_size=(256, 256), 
+                                                        color_mode="grayscale" if self.grayscale else "rgb",
                                                         subset="validation",
                                                         class_mode='categorical')
 
+    def make_dataset(self, images, labels, shuffle: bool = True, cache: bool = True, pyramid: bool = False):
+        """
+            Build a tf.data pipeline from images and family labels, decoding is
+            done in parallel by tf.data instead of the Python generator
+
+            @images: PNG filepaths, or (N, 256, 256) uint8 array of decoded samples
+            @labels: families of the samples
+            @cache: keep decoded samples in memory after the first epoch
+            @pyramid: images are .pyramid.npz filepaths saved by split_files, the
+                level of the model input size is loaded
+        """
+        labels = np.array([families.index(family) for family in labels], dtype=np.int32)
+        dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        if pyramid:
+            size = self.img_size[0]
+
+            def read_level(pyramid_fp, label):
+                image = tf.numpy_function(lambda fp: load_pyramid(fp.decode(), size), [pyramid_fp], tf.uint8)
+                image.set_shape((size, size))
+                return image, label
+
+            dataset = dataset.map(read_level, num_parallel_calls=tf.data.AUTOTUNE)
+        return self.make_pipeline(dataset, len(labels), shuffle, cache)
+
+    def make_pipeline(self, dataset, count: int, shuffle: bool = True, cache: bool = True):
+        """
+            Decode, cache, shuffle, batch and prefetch a dataset of (image, label index),
+            samples are cached as uint8 images and only batches are cast to float
+        """
+        def decode(image, label):
+            if image.dtype == tf.string:
+                image = tf.io.decode_png(tf.io.read_file(image), channels=1)
+            else:
+                image = image[..., tf.newaxis]
+            image = tf.image.resize_with_crop_or_pad(image, self.img_size[0], self.img_size[1])
+            return image, label
+
+        def normalize(images, labels):
+            images = tf.cast(images, tf.float32) / 255
+            # grayscale byte images are repeated on every channel of RGB models
+            if self.input_shape[-1] > 1:
+                images = tf.tile(images, [1, 1, 1, self.input_shape[-1]])
+            return images, tf.one_hot(labels, self.num_classes)
+
+        dataset = dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+        if cache:
+            dataset = dataset.cache()
+        if shuffle:
+            dataset = dataset.shuffle(max(min(count, 4096), 1), reshuffle_each_iteration=True)
+        dataset = dataset.repeat().batch(self.batch_size)
+        dataset = dataset.map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def generate_data_from_manifest(
+        self,
+        manifest_fp: str,
+        train_split: str = "train",
+        test_split: str = "valid",
+        cache: bool = True,
+    ):
+        """
+            Same as generate_data with tf.data pipelines over the images of a
+            split manifest written by generate_dataset in source/utils.py, from
+            their PNG or else from their pyramid
+        """
+        with open(manifest_fp, 'r') as f:
+            samples = json.load(f)["samples"]
+
+        def split_dataset(split, shuffle):
+            entries = [
+                sample for _, sample in sorted(samples.items())
+                if sample["split"] == split and sample["done"]
+            ]
+            labels = [sample["family"] for sample in entries]
+            if all(sample["img_fp"] for sample in entries):
+                images, pyramid = [sample["img_fp"] for sample in entries], False
+            elif all(sample.get("pyramid_fp") for sample in entries):
+                images, pyramid = [sample["pyramid_fp"] for sample in entries], True
+            else:
+                raise ValueError(
+                    f"Samples of the {split} split in {manifest_fp} have no PNG nor pyramid, "
+                    f"load their shards with generate_data_from_shards"
+                )
+            return self.make_dataset(images, labels, shuffle=shuffle, cache=cache, pyramid=pyramid), len(labels)
+
+        self.train_generator, self.no_train_samples = split_dataset(train_split, shuffle=True)
+        self.test_generator, self.no_test_samples = split_dataset(test_split, shuffle=False)
+
+    def generate_data_from_arrays(self, train_images, train_labels, test_images, test_labels, cache: bool = True):
+        """
+            Same as generate_data with tf.data pipelines over decoded samples
+
+            @train_images: PNG filepaths or (N, 256, 256) uint8 array
+            @train_labels: families of the train samples
+        """
+        self.no_train_samples = len(train_labels)
+        self.no_test_samples = len(test_labels)
+        self.train_generator = self.make_dataset(train_images, train_labels, shuffle=True, cache=cache)
+        self.test_generator = self.make_dataset(test_images, test_labels, shuffle=False, cache=cache)
+
+    def make_shard_dataset(
+        self,
+        shard_index_fp: str,
+        split: str,
+        shuffle: bool = True,
+        cache: bool = True,
+        slice_size: int = 256,
+    ):
+        """
+            tf.data pipeline over the .npy shards of a split exported by
+            split_files, shards are memory-mapped and read by slices of
+            consecutive images in parallel
+
+            @shard_index_fp: shards.json written next to the shards
+            @slice_size: number of images read at once from a shard
+        """
+        with open(shard_index_fp, 'r') as f:
+            index = json.load(f)
+        shard_folder = os.path.dirname(shard_index_fp)
+        shards = index["splits"].get(split, [])
+        count = sum(shard["count"] for shard in shards)
+
+        slices = [
+            (f"{shard_folder}/{shard['images']}", f"{shard_folder}/{shard['labels']}", start, min(start + slice_size, shard["count"]))
+            for shard in shards
+            for start in range(0, shard["count"], slice_size)
+        ]
+
+        def read_slice(images_fp, labels_fp, start, stop):
+            images = np.load(images_fp.decode(), mmap_mode='r')[start:stop]
+            labels = np.load(labels_fp.decode(), mmap_mode='r')[start:stop]
+            return np.ascontiguousarray(images), np.array([families.index(int(label)) for label in labels], dtype=np.int32)
+
+        def read(images_fp, labels_fp, start, stop):
+            images, labels = tf.numpy_function(read_slice, [images_fp, labels_fp, start, stop], (tf.uint8, tf.int32))
+            images.set_shape((None, index["height"], index["width"]))
+            labels.set_shape((None,))
+            return images, labels
+
+        dataset = tf.data.Dataset.from_tensor_slices((
+            tf.constant([s[0] for s in slices], dtype=tf.string),
+            tf.constant([s[1] for s in slices], dtype=tf.string),
+            tf.constant([s[2] for s in slices], dtype=tf.int64),
+            tf.constant([s[3] for s in slices], dtype=tf.int64),
+        ))
+        dataset = dataset.map(read, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+        return self.make_pipeline(dataset, count, shuffle, cache), count
+
+    def generate_data_from_shards(
+        self,
+        shard_index_fp: str,
+        train_split: str = "train",
+        test_split: str = "valid",
+        cache: bool = True,
+    ):
+        """
+            Same as generate_data with tf.data pipelines over exported shards
+        """
+        self.train_generator, self.no_train_samples = self.make_shard_dataset(
+            shard_index_fp, train_split, shuffle=True, cache=cache)
+        self.test_generator, self.no_test_samples = self.make_shard_dataset(
+            shard_index_fp, test_split, shuffle=False, cache=cache)
+
     def build_model(self, **kwargs):
         self.model = Sequential()
 
@@ -83,8 +262,8 @@ class MalwareConvNet:
         )
 
     def train(self, model_folder: str = None):
-        steps_per_epoch = self.no_train_s // self.batch_size
-        test_steps = self.no_test_samples // self.batch_size
+        steps_per_epoch = max(self.no_train_samples // self.batch_size, 1)
+        test_steps = max(self.no_test_samples // self.batch_size, 1)
         model_checkpoint_fp = f"{model_folder}/{datetime.datetime.now()}_checkpoint.h5"
         print(f"Store in {model_checkpoint_fp}")
 
@@ -101,8 +280,15 @@ class MalwareConvNet:
         train_folder = kwargs.get("train_folder", "")
         test_folder = kwargs.get("test_folder", "")
         model_folder = kwargs.get("model_folder", "")
+        manifest_fp = kwargs.get("manifest_fp")
+        shard_index_fp = kwargs.get("shard_index_fp")
 
-        self.generate_data(train_folder, test_folder)
+        if shard_index_fp:
+            self.generate_data_from_shards(shard_index_fp)
+        elif manifest_fp:
+            self.generate_data_from_manifest(manifest_fp)
+        else:
+            self.generate_data(train_folder, test_folder)
         self.build_model()
         self.train(model_folder)
 
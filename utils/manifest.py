@@ -0,0 +1,57 @@
+"""
+    Manifests of the splits written by split_files in source/utils.py and
+    the asm index of get_asm_files, shared with the RL environment in RL/
+"""
+
+import json
+import os
+from typing import (
+    Dict,
+    List
+)
+
+
+def load_manifest(manifest_fp: str) -> Dict:
+    if manifest_fp and os.path.isfile(manifest_fp):
+        with open(manifest_fp, 'r') as f:
+            return json.load(f)
+    return {"samples": {}}
+
+
+def save_manifest(manifest: Dict, manifest_fp: str) -> None:
+    # write to a temporary file first so a crash never leaves a truncated manifest
+    with open(f"{manifest_fp}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{manifest_fp}.tmp", manifest_fp)
+
+
+def resolve_split(manifest_fp: str, split: str, family: int = None) -> List[str]:
+    """
+        Get bytes filepaths of a split from its manifest
+
+        @family: only files of this family
+    """
+    samples = load_manifest(manifest_fp)["samples"]
+    return [
+        sample["bytes_fp"] for _, sample in sorted(samples.items())
+        if sample["split"] == split and sample["done"]
+        and (family is None or sample["family"] == family)
+    ]
+
+
+def load_asm_index(asm_folder: str, family: int = None) -> Dict[str, str]:
+    """
+        Get asm filepaths by file name from the index.json written by get_asm_files
+        with link_mode "index", in asm_folder or in its parent for a family folder
+
+        @family: only files of this family
+        @return: empty if there is no index
+    """
+    asm_folder = os.path.normpath(asm_folder)
+    for index_fp in (f"{asm_folder}/index.json", f"{os.path.dirname(asm_folder)}/index.json"):
+        if os.path.isfile(index_fp):
+            with open(index_fp, 'r') as f:
+                index = json.load(f)
+            keys = [str(family)] if family is not None and str(family) in index else list(index)
+            return {os.path.basename(fp): fp for key in keys for fp in index[key]}
+    return {}
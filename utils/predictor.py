@@ -1,51 +1,207 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
+from typing import (
+    Dict,
+    List,
+    Union
+)
 
 import cv2
 import numpy as np
 from keras.models import load_model
 
+import profiling
 import utils
 
 
+class Predictor:
+    """
+        Classifier loaded once and kept in memory
+
+        @model_fp: model checkpoint
+        @batch_size: number of samples per forward pass
+        @workers: number of threads decoding inputs
+        @img_shape: model input shape, taken from the model when None,
+            [256, 256, 1] keeps grayscale byte images on a single channel
+        @save_image: also save the image of bytes inputs to {bytes_fp}.png,
+            default of load_input
+        @model: already loaded model, model_fp is not loaded then
+    """
+
+    def __init__(
+        self,
+        model_fp: str,
+        batch_size: int = 32,
+        workers: int = 4,
+        img_shape = None,
+        save_image: bool = False,
+        model = None,
+    ):
+        self.model_fp = model_fp
+        self.batch_size = batch_size
+        self.workers = workers
+        self.save_image = save_image
+
+        if model is not None:
+            self.model = model
+        else:
+            self.model = load_model(model_fp)
+            self.model.compile(
+                loss='categorical_crossentropy',
+                optimizer='adam',
+                metrics=['accuracy'],
+            )
+
+        if img_shape is None:
+            model_shape = getattr(self.model, "input_shape", None)
+            if isinstance(model_shape, tuple) and len(model_shape) == 4 and None not in model_shape[1:]:
+                img_shape = list(model_shape[1:])
+            else:
+                img_shape = [256, 256, 3]
+        self.img_shape = list(img_shape)
+
+    def load_input(self, item: Union[str, np.ndarray], save_image: bool = None) -> np.ndarray:
+        """
+            Decode a sample to the model input shape
+
+            @item: bytes filepath, image filepath or image array
+            @save_image: save the image of a bytes input, self.save_image when None
+        """
+        with profiling.timer("load_input"):
+            return self.decode_input(item, self.save_image if save_image is None else save_image)
+
+    def decode_input(self, item: Union[str, np.ndarray], save_image: bool = False) -> np.ndarray:
+        if isinstance(item, np.ndarray):
+            img = item
+        elif item.endswith(".bytes"):
+            # decoded image is fed to the model without going through the disk
+            pil_img = utils.byte2img_square(item, self.img_shape[1], self.img_shape[0])
+            if pil_img is None:
+                raise ValueError(f"Cant convert bytes to image {item}")
+            if save_image:
+                with profiling.timer("png_encode"):
+                    pil_img.save(f"{item}.png")
+            img = np.asarray(pil_img)
+        else:
+            flags = cv2.IMREAD_GRAYSCALE if self.img_shape[-1] == 1 else cv2.IMREAD_COLOR
+            img = cv2.imread(item, flags)
+            if img is None:
+                raise ValueError(f"Cant read image {item}")
+
+        # grayscale byte images are repeated on every channel of RGB models
+        if img.ndim == 2 and self.img_shape[-1] > 1:
+            img = np.stack((img,) * self.img_shape[-1], axis=-1)
+        return np.reshape(img, self.img_shape)
+
+    def try_load_input(self, item: Union[str, np.ndarray]):
+        try:
+            return self.load_input(item)
+        except Exception as e:
+            logger.error(f"Cant load input {item if isinstance(item, str) else 'array'}: {e}")
+            profiling.count("inputs_failed")
+
+    def predict_batch(self, inputs: List[np.ndarray]) -> np.ndarray:
+        """
+            Forward passes of at most batch_size inputs with predict_on_batch,
+            model.predict builds a new data pipeline on every call
+        """
+        profiling.count("samples_predicted", len(inputs))
+        batch = np.stack(inputs)
+        with profiling.timer("model_predict"):
+            return np.concatenate([
+                np.asarray(self.model.predict_on_batch(batch[i: i + self.batch_size]))
+                for i in range(0, len(batch), self.batch_size)
+            ])
+
+    def predict_many(self, items: List[Union[str, np.ndarray]]) -> np.ndarray:
+        """
+            Predict family probabilities of many samples, inputs are decoded in
+            parallel, the next batch is decoded while the current one is predicted
+
+            @items: bytes filepaths, image filepaths or image arrays
+            @return: (len(items), num_classes) probabilities, NaN rows for inputs which cant be decoded
+        """
+        results = [None] * len(items)
+        chunks = [range(i, min(i + self.batch_size, len(items))) for i in range(0, len(items), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit(chunk):
+                return [executor.submit(self.try_load_input, items[i]) for i in chunk]
+
+            futures = submit(chunks[0]) if chunks else []
+            for n, chunk in enumerate(chunks):
+                inputs = [(i, future.result()) for i, future in zip(chunk, futures)]
+                if n + 1 < len(chunks):
+                    futures = submit(chunks[n + 1])
+
+                inputs = [(i, x) for i, x in inputs if x is not None]
+                if inputs:
+                    res = self.predict_batch([x for _, x in inputs])
+                    for (i, _), probs in zip(inputs, res):
+                        results[i] = probs
+
+        num_classes = next((len(res) for res in results if res is not None), 0)
+        return np.array([
+            res if res is not None else np.full(num_classes, np.nan)
+            for res in results
+        ])
+
+
+# predictors by model checkpoint and settings, models are loaded once per
+# process and shared by the predictors of a checkpoint
+predictors: Dict[tuple, Predictor] = {}
+models: Dict[str, object] = {}
+
+
+def get_predictor(model_fp: str, **kwargs) -> Predictor:
+    """
+        @kwargs: settings of Predictor, a predictor is kept for every settings
+    """
+    key = (model_fp, tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in kwargs.items()
+    )))
+    if key not in predictors:
+        predictor = Predictor(model_fp, model=models.get(model_fp), **kwargs)
+        models[model_fp] = predictor.model
+        predictors[key] = predictor
+    return predictors[key]
+
+
 def predict(
     model_fp: str,
     bytes_fp: str = None,
     image_fp: str = None,
-    img_shape = [1, 256, 256, 3]
+    img_shape = None,
+    corpus_fp: str = None,
+    save_image: bool = False,
 ):
+    if corpus_fp:
+        utils.load_corpus(corpus_fp)
+
     # load model
-    model = load_model(model_fp)
-    model.compile(
-        loss='categorical_crossentropy',
-        optimizer='adam',
-        metrics=['accuracy'],
-    )
+    predictor = get_predictor(model_fp, img_shape=img_shape[1:] if img_shape else None)
 
     if bytes_fp and image_fp:
         logger.error('bytes_fp and image_fp are not passed at the same time')
         return
 
-    if bytes_fp:
-        img = utils.byte2img_square(bytes_fp)
-        if not img:
-            logger.error(f"Cant convert bytes to image")
-            return
-        image_fp = f"{bytes_fp}.png"
-        img.save(image_fp)
-    
-    if not image_fp:
+    if not bytes_fp and not image_fp:
         logger.error(f"No image to predict")
         return
 
-    img = cv2.imread(image_fp)
-    img_np = np.reshape(img, img_shape)
+    try:
+        img_np = predictor.load_input(bytes_fp or image_fp, save_image=save_image)
+    except Exception as e:
+        logger.error(f"Cant convert bytes to image: {e}")
+        return
+    img_np = np.reshape(img_np, [1] + predictor.img_shape)
 
     # predict
     try:
-        res = model.predict(img_np)
+        res = predictor.predict_batch(list(img_np))
     except Exception as e:
-        logger.error(f"Cant predict {image_fp}")
+        logger.error(f"Cant predict {bytes_fp or image_fp}")
         res = [[]]
 
     return res
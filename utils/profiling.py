@@ -0,0 +1,158 @@
+"""
+    Named timers and counters of the pipeline stages, off by default.
+
+    Enable with profiling.enable() or the environment variables
+    KLTN_PROFILE=1, KLTN_PROFILE_INTERVAL (seconds between summaries) and
+    KLTN_PROFILE_JSON (summary file, "{pid}" is replaced by the process id
+    since worker processes keep their own stats).
+
+        with profiling.timer("hex_decode"):
+            ...
+        profiling.count("files_converted")
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from loguru import logger
+from typing import (
+    Dict,
+    Optional
+)
+
+import numpy as np
+
+enabled = False
+interval = 60.0
+json_fp: Optional[str] = None
+
+# samples kept per timer to compute percentiles
+MAX_SAMPLES = 2048
+
+lock = threading.Lock()
+timers: Dict[str, Dict] = {}
+counters: Dict[str, int] = {}
+last_dump = time.monotonic()
+
+
+def enable(dump_interval: float = 60.0, dump_json_fp: str = None) -> None:
+    """
+        @dump_interval: seconds between two summaries
+        @dump_json_fp: write summaries to this JSON file instead of the log
+    """
+    global enabled, interval, json_fp, last_dump
+    enabled = True
+    interval = dump_interval
+    json_fp = dump_json_fp
+    last_dump = time.monotonic()
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+def reset() -> None:
+    with lock:
+        timers.clear()
+        counters.clear()
+
+
+class timer:
+    """
+        Context manager timing a stage, does nothing when profiling is disabled
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled and self.start is not None:
+            record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def record(name: str, seconds: float) -> None:
+    with lock:
+        stat = timers.get(name)
+        if stat is None:
+            stat = timers[name] = {"count": 0, "total": 0.0, "samples": deque(maxlen=MAX_SAMPLES)}
+        stat["count"] += 1
+        stat["total"] += seconds
+        stat["samples"].append(seconds)
+    maybe_dump()
+
+
+def count(name: str, n: int = 1) -> None:
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+    maybe_dump()
+
+
+def summary() -> Dict:
+    with lock:
+        return {
+            "timers": {
+                name: {
+                    "count": stat["count"],
+                    "total": stat["total"],
+                    "mean": stat["total"] / stat["count"],
+                    "p95": float(np.percentile(stat["samples"], 95)),
+                }
+                for name, stat in timers.items()
+            },
+            "counters": dict(counters),
+        }
+
+
+def dump() -> None:
+    global last_dump
+    last_dump = time.monotonic()
+    stats = summary()
+    if not stats["timers"] and not stats["counters"]:
+        return
+
+    if json_fp:
+        fp = json_fp.replace("{pid}", str(os.getpid()))
+        with open(f"{fp}.tmp", 'w') as f:
+            json.dump(stats, f, indent=1)
+        os.replace(f"{fp}.tmp", fp)
+        return
+
+    for name, stat in sorted(stats["timers"].items()):
+        logger.info(
+            f"[profile] {name}: count={stat['count']} total={stat['total']:.3f}s "
+            f"mean={stat['mean'] * 1000:.3f}ms p95={stat['p95'] * 1000:.3f}ms"
+        )
+    for name, value in sorted(stats["counters"].items()):
+        logger.info(f"[profile] {name}: {value}")
+
+
+def maybe_dump() -> None:
+    if time.monotonic() - last_dump >= interval:
+        dump()
+
+
+@atexit.register
+def dump_at_exit() -> None:
+    if enabled:
+        dump()
+
+
+if os.environ.get("KLTN_PROFILE", "") not in ("", "0"):
+    enable(
+        float(os.environ.get("KLTN_PROFILE_INTERVAL", 60.0)),
+        os.environ.get("KLTN_PROFILE_JSON") or None,
+    )
@@ -0,0 +1,193 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+from typing import (
+    Dict,
+    List
+)
+
+import numpy as np
+
+from configs import families
+from predictor import Predictor
+
+
+class MicroBatcher:
+    """
+        Collect concurrent requests into batches for one predictor, a batch is
+        predicted when it is full or when its oldest request waited max_latency
+
+        @max_batch_size: max number of samples per forward pass
+        @max_latency: max seconds a request waits for other requests
+    """
+
+    def __init__(self, predictor: Predictor, max_batch_size: int = 32, max_latency: float = 0.005):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item) -> Future:
+        # decode in the caller thread, only inference is batched
+        future = Future()
+        try:
+            self.requests.put((self.predictor.load_input(item), future))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self) -> None:
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                res = self.predictor.predict_batch([x for x, _ in batch])
+                for (_, future), probs in zip(batch, res):
+                    future.set_result(probs)
+            except Exception as e:
+                logger.error(f"Cant predict batch of {len(batch)}: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def make_handler(batcher: MicroBatcher):
+
+    class PredictHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.reply(404, {"error": f"Unknown path {self.path}"})
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                item = body.get("bytes_fp") or body.get("image_fp")
+                if not item:
+                    raise ValueError("bytes_fp or image_fp is required")
+                probs = batcher.submit(item).result()
+            except Exception as e:
+                self.reply(400, {"error": str(e)})
+                return
+
+            self.reply(200, {
+                "family": families[int(np.argmax(probs))],
+                "probabilities": [float(p) for p in probs],
+            })
+
+        def reply(self, code: int, body: Dict):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictHandler
+
+
+def serve(
+    model_fp: str,
+    host: str = "127.0.0.1",
+    port: int = 8500,
+    max_batch_size: int = 32,
+    max_latency: float = 0.005,
+) -> None:
+    """
+        Serve POST /predict with {"bytes_fp": ...} or {"image_fp": ...},
+        one model is kept in memory for every client
+    """
+    predictor = Predictor(model_fp, batch_size=max_batch_size)
+    batcher = MicroBatcher(predictor, max_batch_size, max_latency)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    logger.info(f"Serving {model_fp} on http://{host}:{port}/predict")
+    server.serve_forever()
+
+
+def load_test(
+    url: str,
+    items: List[str],
+    requests: int = 1000,
+    concurrency: int = 16,
+) -> Dict[str, float]:
+    """
+        Send requests for items in a loop from concurrency threads and
+        report throughput and latency percentiles
+
+        @items: bytes or image filepaths visible by the server
+    """
+    def send(i):
+        item = items[i % len(items)]
+        key = "bytes_fp" if item.endswith(".bytes") else "image_fp"
+        data = json.dumps({key: item}).encode()
+        request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            success = True
+        except Exception as e:
+            logger.warning(f"Request {item} failed: {e}")
+            success = False
+        return time.perf_counter() - start, success
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results])
+    report = {
+        "requests": requests,
+        "failures": sum(not success for _, success in results),
+        "concurrency": concurrency,
+        "throughput": requests / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+    }
+    logger.info(f"Load test: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching malware classifier server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument("model_fp")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8500)
+    serve_parser.add_argument("--max-batch-size", type=int, default=32)
+    serve_parser.add_argument("--max-latency", type=float, default=0.005)
+
+    load_parser = commands.add_parser("load")
+    load_parser.add_argument("items", nargs="+")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8500/predict")
+    load_parser.add_argument("--requests", type=int, default=1000)
+    load_parser.add_argument("--concurrency", type=int, default=16)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.model_fp, args.host, args.port, args.max_batch_size, args.max_latency)
+    else:
+        print(json.dumps(load_test(args.url, args.items, args.requests, args.concurrency)))